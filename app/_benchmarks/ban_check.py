@@ -0,0 +1,131 @@
+"""
+Compares the ways the ban status of a user has been checked, at 0, 10 and
+1000 bans per user:
+    joinedload: the User with every Ban (joinedload), checked in Python;
+    exists: an EXISTS over the active bans plus their latest end_date;
+    banned_until: get_user_status, the denormalized users.banned_until.
+The first two are kept here as reference implementations, they no longer
+exist in db.crud. Only banned_until should not depend on the number of bans.
+
+Run from the app directory against a disposable database:
+    python -m _benchmarks.ban_check --iterations 500
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from db.base import _db_init, engine, get_session
+from db.crud import get_user_status
+from db.models import Ban, User
+from db.passwords import pwd_context
+from sqlalchemy import and_, delete, exists, func, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from ulid import ULID
+
+BANS_PER_USER = (0, 10, 1000)
+
+
+async def _create_user(bans_count: int) -> str:
+    user_id = str(ULID())
+    past = datetime.now() - timedelta(days=1)
+    async with get_session() as session:
+        await session.execute(insert(User).values(
+            id=user_id, username=f'bench{user_id[-12:]}',
+            password=pwd_context.hash('QweQwe123!'), role='_'
+        ))
+        if bans_count:
+            await session.execute(insert(Ban), [
+                {'id': str(ULID()), 'user_id': user_id,
+                 'reason': Ban.Reason.INAPPROPRIATE_BEHAVIOR,
+                 'end_date': past - timedelta(minutes=i)}
+                for i in range(bans_count)
+            ])
+        await session.commit()
+    return user_id
+
+
+async def _drop_user(user_id: str) -> None:
+    async with get_session() as session:
+        await session.execute(delete(Ban).where(Ban.user_id == user_id))
+        await session.execute(delete(User).where(User.id == user_id))
+        await session.commit()
+
+
+def _active_ban_clause():
+    return and_(Ban.user_id == User.id, 
+                or_(Ban.end_date == None, Ban.end_date > func.now()))
+
+
+async def joinedload_status(session: AsyncSession, user_id: str) -> tuple[bool, datetime | None]:
+    result = await session.execute(
+        select(User).options(joinedload(User.ban)).where(User.id == user_id))
+    user = result.unique().scalars().first()
+    if user is None:
+        return False, None
+    now = datetime.now()
+    active = [ban.end_date or datetime.max for ban in user.ban 
+              if ban.end_date is None or ban.end_date > now]
+    return True, max(active, default=None)
+
+
+async def exists_status(session: AsyncSession, user_id: str) -> tuple[bool, datetime | None]:
+    banned_until = (
+        select(Ban.end_date)
+        .where(_active_ban_clause())
+        .order_by(Ban.end_date.desc().nulls_first())
+        .limit(1)
+    )
+    row = (await session.execute(
+        select(exists().where(_active_ban_clause()).label('is_banned'),
+               banned_until.scalar_subquery().label('banned_until'))
+        .select_from(User)
+        .where(User.id == user_id)
+    )).first()
+    if row is None:
+        return False, None
+    is_banned, until = row
+    return True, (until or datetime.max) if is_banned else None
+
+
+async def _measure(func, user_id: str, iterations: int) -> list[float]:
+    timings = []
+    async with get_session() as session:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            await func(session, user_id)
+            timings.append(time.perf_counter() - start)
+            session.expunge_all()
+    return timings
+
+
+def _report(name: str, bans_count: int, timings: list[float]) -> None:
+    quantiles = statistics.quantiles(timings, n=100)
+    print(f'{name:<16} bans={bans_count:<5} '
+          f'p50={quantiles[49] * 1000:.3f}ms p95={quantiles[94] * 1000:.3f}ms '
+          f'mean={statistics.fmean(timings) * 1000:.3f}ms')
+
+
+async def main(iterations: int) -> None:
+    await _db_init()
+    for bans_count in BANS_PER_USER:
+        user_id = await _create_user(bans_count)
+        try:
+            for name, status in (('joinedload', joinedload_status),
+                                 ('exists', exists_status),
+                                 ('banned_until', get_user_status)):
+                await _measure(status, user_id, min(iterations, 20))  # warm up
+                _report(name, bans_count, await _measure(status, user_id, iterations))
+        finally:
+            await _drop_user(user_id)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(main(iterations=args.iterations))
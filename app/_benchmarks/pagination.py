@@ -0,0 +1,80 @@
+"""
+Compares OFFSET and keyset (WHERE id > :after) pagination of the users table
+at page 1 and page 10,000 (and any other pages passed with --pages). The
+statements mirror what the users resolver builds for a plain listing.
+
+The users table has to hold at least pages * page size rows, seed it first:
+    python _db_filling.py --users 110000 --libraries-per-user 0 --bans-ratio 0
+
+Run from the app directory:
+    python -m _benchmarks.pagination --page-size 10 --pages 1 100 10000
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Optional
+
+from db.base import engine, get_session
+from db.models import User
+from sqlalchemy import select
+
+FIELDS = (User.id, User.username, User.first_name, User.last_name)
+
+
+def _offset_stmt(page: int, page_size: int):
+    return select(*FIELDS).order_by(User.id).offset((page - 1) * page_size).limit(page_size)
+
+
+def _keyset_stmt(after: Optional[str], page_size: int):
+    stmt = select(*FIELDS)
+    if after is not None:
+        stmt = stmt.where(User.id > after)
+    return stmt.order_by(User.id).limit(page_size)
+
+
+async def _cursor_for(page: int, page_size: int) -> Optional[str]:
+    # the cursor of a page is the id of the last row of the previous one
+    if page == 1:
+        return None
+    async with get_session() as session:
+        return await session.scalar(
+            select(User.id).order_by(User.id).offset((page - 1) * page_size - 1).limit(1))
+
+
+async def _measure(stmt, iterations: int) -> list[float]:
+    timings = []
+    async with get_session() as session:
+        await session.execute(stmt)  # warm up
+        for _ in range(iterations):
+            start = time.perf_counter()
+            (await session.execute(stmt)).fetchall()
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _report(name: str, page: int, timings: list[float]) -> None:
+    quantiles = statistics.quantiles(timings, n=100)
+    print(f'{name:<7} page={page:<6} p50={quantiles[49] * 1000:.3f}ms '
+          f'p95={quantiles[94] * 1000:.3f}ms mean={statistics.fmean(timings) * 1000:.3f}ms')
+
+
+async def main(pages: list[int], page_size: int, iterations: int) -> None:
+    for page in pages:
+        after = await _cursor_for(page, page_size)
+        if page > 1 and after is None:
+            print(f'page={page} is past the end of the users table, skipping')
+            continue
+        _report('offset', page, await _measure(_offset_stmt(page, page_size), iterations))
+        _report('keyset', page, await _measure(_keyset_stmt(after, page_size), iterations))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, nargs='+', default=[1, 10_000])
+    parser.add_argument('--page-size', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main(pages=args.pages, page_size=args.page_size, iterations=args.iterations))
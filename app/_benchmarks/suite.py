@@ -0,0 +1,289 @@
+"""
+Benchmark suite for the Users service hot paths.
+
+The FastAPI app (v1 router and /graphql) runs in-process behind an
+httpx.ASGITransport, so no server or network is involved. Service and client
+token checks are replaced with fixed payloads, and the Authentication service
+is replaced with a local fake of SelfService.post_request, so only the work
+done by this service is measured. The database is the PostgreSQL instance
+from DATABASE_URL (the service relies on PostgreSQL-only features, so SQLite
+can't stand in for it); point it to a disposable database, the suite seeds
+it with _db_filling.py when it holds fewer users than requested.
+
+Every scenario reports p50/p95/p99 latency and throughput, the results can be
+stored as JSON and compared with an earlier run:
+
+    python -m _benchmarks.suite --users 10000 --output bench.json
+    python -m _benchmarks.suite --users 10000 --compare bench.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import re
+import statistics
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Optional
+
+import _db_filling
+import api.graphql.deps as graphql_deps
+import config
+import httpx
+from api import router
+from api.deps import verify_service_token, verify_user_token
+from api.graphql.resolvers import resolvers
+from api.graphql.route import create_graphql_route
+from db.base import engine, get_read_session, get_session
+from db.models import User
+from fastapi import FastAPI
+from patisson_request.jwt_tokens import ClientAccessTokenPayload
+from patisson_request.roles import ClientRole
+from sqlalchemy import func, select
+
+TOKEN_PREFIX = 'bench-token:'
+PREFIX = f'/{config.SERVICE_NAME}/api/v1'
+REGRESSION_THRESHOLD = 0.10  # relative p95/throughput change reported as a regression
+
+Request = Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+
+class FakeAuthentication:
+    '''
+    Stands in for config.SelfService.post_request. The routes are told apart
+    by their path, client tokens have the form bench-token:<user id>. 
+    failure_rate of the calls raise a transport error, to exercise 
+    the timeouts and the circuit breaker of api.upstream
+    '''
+
+    def __init__(self, latency: float = 0, failure_rate: float = 0, seed: int = 0) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    @staticmethod
+    def payload(user_id: str) -> ClientAccessTokenPayload:
+        return ClientAccessTokenPayload.model_construct(
+            sub=user_id, role=ClientRole.MEMBER,
+            exp=int((datetime.now() + timedelta(hours=1)).timestamp())
+        )
+
+    async def post_request(self, *args: Any, **kwargs: Any) -> Any:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self.rng.random() < self.failure_rate:
+            raise ConnectionError('fake Authentication failure')
+        request = repr((args, kwargs))
+        if 'verify' in request:
+            match = re.search(re.escape(TOKEN_PREFIX) + r'([0-9A-Za-z]+)', request)
+            if match is None:
+                return SimpleNamespace(is_error=False, body=SimpleNamespace(
+                    is_verify=False, payload=None, error=SimpleNamespace(error='JWT_INVALID')))
+            return SimpleNamespace(is_error=False, body=SimpleNamespace(
+                is_verify=True, payload=self.payload(match.group(1)), error=None))
+        # jwt.create and jwt.update
+        return SimpleNamespace(is_error=False, body=SimpleNamespace(
+            access_token=f'{TOKEN_PREFIX}new', refresh_token='bench-refresh'))
+
+
+def create_app() -> FastAPI:
+    service = SimpleNamespace(sub='benchmark', role=SimpleNamespace(permissions=SimpleNamespace(
+        user_reg=True)))
+    client = SimpleNamespace(sub='benchmark', role=SimpleNamespace(permissions=SimpleNamespace(
+        create_lib=True, create_ban=True)))
+
+    async def graphql_service_token(context):
+        return service
+    async def graphql_client_token(context):
+        return client
+    graphql_deps.verify_service_token = graphql_service_token  # type: ignore[reportAttributeAccessIssue]
+    graphql_deps.verify_client_token = graphql_client_token  # type: ignore[reportAttributeAccessIssue]
+
+    app = FastAPI()
+    app.include_router(router, prefix=f'/{config.SERVICE_NAME}')
+    app.add_route('/graphql', create_graphql_route(resolvers, get_read_session), methods=["POST"])
+    app.dependency_overrides[verify_service_token] = lambda: service
+    app.dependency_overrides[verify_user_token] = lambda: client
+    return app
+
+
+@dataclass
+class Scenario:
+    name: str
+    request: Request
+
+
+def graphql(query: str, variables: Callable[[int], dict[str, Any]]) -> Request:
+    async def request(client: httpx.AsyncClient, i: int) -> httpx.Response:
+        return await client.post('/graphql', json={'query': query, 'variables': variables(i)})
+    return request
+
+
+def scenarios(user_ids: list[str], run_id: str) -> list[Scenario]:
+    ids = itertools.cycle(user_ids)
+
+    async def verify_user(client: httpx.AsyncClient, i: int) -> httpx.Response:
+        return await client.post(f'{PREFIX}/verify-user',
+                                 json={'access_token': TOKEN_PREFIX + next(ids)})
+
+    async def verify_users(client: httpx.AsyncClient, i: int) -> httpx.Response:
+        return await client.post(f'{PREFIX}/verify-users', json={
+            'access_tokens': [TOKEN_PREFIX + next(ids) for _ in range(20)]})
+
+    async def create_user(client: httpx.AsyncClient, i: int) -> httpx.Response:
+        return await client.post(f'{PREFIX}/create-user', json={
+            'username': f'bench{run_id}x{i}', 'password': _db_filling.PASSWORD,
+            'first_name': 'Bench', 'last_name': 'Mark'})
+
+    return [
+        Scenario('rest.verify_user', verify_user),
+        Scenario('rest.verify_users_x20', verify_users),
+        Scenario('rest.create_user', create_user),
+        Scenario('graphql.users_by_ids', graphql(
+            'query ($ids: [ID]) { users(ids: $ids) { id username firstName lastName } }',
+            lambda i: {'ids': [next(ids) for _ in range(10)]})),
+        Scenario('graphql.users_not_banned', graphql(
+            'query { users(is_banned: false, limit: 50) { id username } }',
+            lambda i: {})),
+        Scenario('graphql.users_page', graphql(
+            'query ($after: ID) { users_page(after: $after, limit: 50) { items { id username } next_cursor } }',
+            lambda i: {'after': user_ids[(i * 50) % len(user_ids)]})),
+        Scenario('graphql.libraries_by_user_ids', graphql(
+            'query ($ids: [String]) { libraries(user_ids: $ids, limit: 100) { id book_id status } }',
+            lambda i: {'ids': [next(ids) for _ in range(10)]})),
+        Scenario('graphql.users_with_libraries', graphql(
+            'query ($ids: [ID]) { users(ids: $ids) { id username isBanned libraries { book_id status } } }',
+            lambda i: {'ids': [next(ids) for _ in range(10)]})),
+    ]
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: Scenario,
+                       requests: int, concurrency: int, warmup: int) -> dict[str, Any]:
+    for i in range(requests, requests + warmup):
+        await scenario.request(client, i)
+
+    timings: list[float] = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker() -> None:
+        nonlocal errors
+        while (i := next(counter)) < requests:
+            start = time.perf_counter()
+            response = await scenario.request(client, i)
+            timings.append(time.perf_counter() - start)
+            if response.status_code >= 400 or 'errors' in response.text[:100]:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    quantiles = statistics.quantiles(timings, n=100)
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'concurrency': concurrency,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'throughput_rps': len(timings) / elapsed,
+    }
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any]) -> bool:
+    '''
+    Prints the relative change against the baseline run,
+    returns False if any scenario regressed by more than REGRESSION_THRESHOLD
+    '''
+    ok = True
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            print(f'{name:<32} no baseline')
+            continue
+        p95 = result['p95_ms'] / base['p95_ms'] - 1
+        rps = result['throughput_rps'] / base['throughput_rps'] - 1
+        regressed = p95 > REGRESSION_THRESHOLD or rps < -REGRESSION_THRESHOLD
+        ok = ok and not regressed
+        print(f'{name:<32} p95 {p95:+.1%} throughput {rps:+.1%}'
+              + ('  REGRESSION' if regressed else ''))
+    return ok
+
+
+async def main(users: int, requests: int, concurrency: int, warmup: int,
+               auth_latency: float, auth_failure_rate: float, only: Optional[list[str]],
+               output: Optional[str], baseline: Optional[str]) -> int:
+    async with get_session() as session:
+        users_count = await session.scalar(select(func.count()).select_from(User))
+    if users_count < users:
+        await _db_filling.main(
+            users_count=users - users_count, libraries_per_user=10, bans_ratio=0.1,
+            books_count=1000, batch_size=5000, seed=0)
+    async with get_session() as session:
+        user_ids = list((await session.execute(
+            select(User.id).order_by(User.id).limit(users))).scalars().all())
+
+    fake_authentication = FakeAuthentication(latency=auth_latency, failure_rate=auth_failure_rate)
+    config.SelfService.post_request = fake_authentication.post_request  # type: ignore[reportAttributeAccessIssue]
+    transport = httpx.ASGITransport(app=create_app())
+    results: dict[str, Any] = {}
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        for scenario in scenarios(user_ids, run_id=str(int(time.time()))):
+            if only and not any(name in scenario.name for name in only):
+                continue
+            results[scenario.name] = result = await run_scenario(
+                client, scenario, requests, concurrency, warmup)
+            print(f'{scenario.name:<32} p50={result["p50_ms"]:.2f}ms p95={result["p95_ms"]:.2f}ms '
+                  f'p99={result["p99_ms"]:.2f}ms {result["throughput_rps"]:.0f} rps'
+                  + (f' errors={result["errors"]}' if result['errors'] else ''))
+    await engine.dispose()
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'users': users, 'requests': requests, 'concurrency': concurrency,
+            'auth_latency': auth_latency, 'auth_failure_rate': auth_failure_rate,
+            'authentication_calls': fake_authentication.calls,
+        },
+        'results': results,
+    }
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if baseline:
+        with open(baseline) as file:
+            return 0 if compare(results, json.load(file)) else 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000, help='users to seed/use')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=50, help='untimed requests per scenario')
+    parser.add_argument('--auth-latency', type=float, default=0.0,
+                        help='simulated Authentication service latency, seconds')
+    parser.add_argument('--auth-failure-rate', type=float, default=0.0,
+                        help='share of the Authentication calls failing with a transport error')
+    parser.add_argument('--only', nargs='*', help='run only scenarios containing these names')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results stored in this JSON file')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(
+        users=args.users, requests=args.requests, concurrency=args.concurrency,
+        warmup=args.warmup, auth_latency=args.auth_latency,
+        auth_failure_rate=args.auth_failure_rate, only=args.only,
+        output=args.output, baseline=args.compare
+    )))
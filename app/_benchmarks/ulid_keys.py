@@ -0,0 +1,147 @@
+"""
+Compares the two storages of the ULID keys (see db.types): varchar and
+native uuid. For each, a parent table of --rows keys and a child table of
+--children-per-row rows referencing it are created and filled with COPY,
+then the sizes of the tables and of their key indexes are reported, along
+with the latency of a lookup by id, an IN filter of --in-size ids and
+a join of the child rows of --in-size parents, as the resolvers issue them.
+
+The tables (ulid_bench_*) are dropped at the end. Run from the app directory
+against a disposable database:
+    python -m _benchmarks.ulid_keys --rows 100000 --iterations 500
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from itertools import batched
+
+from db.base import engine, get_session
+from db.types import ULIDKey, to_storage
+from sqlalchemy import (Column, ForeignKey, Index, MetaData, String, Table,
+                        select, text)
+from ulid import ULID
+
+STORAGES = {'varchar': False, 'uuid': True}
+BATCH_SIZE = 10_000
+
+
+def _tables(name: str, as_uuid: bool) -> tuple[Table, Table]:
+    metadata = MetaData()
+    parents = Table(
+        f'ulid_bench_{name}', metadata,
+        Column('id', ULIDKey(as_uuid), primary_key=True),
+        Column('payload', String),
+    )
+    children = Table(
+        f'ulid_bench_{name}_children', metadata,
+        Column('id', ULIDKey(as_uuid), primary_key=True),
+        Column('parent_id', ULIDKey(as_uuid), ForeignKey(parents.c.id), nullable=False),
+        Index(f'ix_ulid_bench_{name}_children_parent_id', 'parent_id'),
+    )
+    return parents, children
+
+
+def _ulids(rng: random.Random, count: int) -> list[str]:
+    timestamp = int(time.time() * 1000)
+    return [str(ULID.from_bytes((timestamp + i).to_bytes(6, 'big') + rng.randbytes(10)))
+            for i in range(count)]
+
+
+async def _fill(parents: Table, children: Table, as_uuid: bool, ids: list[str],
+                child_ids: list[str], children_per_row: int) -> None:
+    async with engine.connect() as conn:
+        await conn.run_sync(parents.metadata.drop_all)
+        await conn.run_sync(parents.metadata.create_all)
+        await conn.commit()
+        driver_connection = (await conn.get_raw_connection()).driver_connection
+        for batch in batched(ids, BATCH_SIZE):
+            await driver_connection.copy_records_to_table(  # type: ignore[reportOptionalMemberAccess]
+                parents.name, records=[(to_storage(id_, as_uuid), 'x') for id_ in batch],
+                columns=['id', 'payload'])
+        records = ((to_storage(child_id, as_uuid), to_storage(ids[i // children_per_row], as_uuid))
+                   for i, child_id in enumerate(child_ids))
+        for batch in batched(records, BATCH_SIZE):
+            await driver_connection.copy_records_to_table(  # type: ignore[reportOptionalMemberAccess]
+                children.name, records=batch, columns=['id', 'parent_id'])
+        await conn.execute(text(f'ANALYZE {parents.name}'))
+        await conn.execute(text(f'ANALYZE {children.name}'))
+        await conn.commit()
+
+
+async def _sizes(parents: Table, children: Table) -> dict[str, int]:
+    relations = {
+        'parents table': parents.name,
+        'parents pkey': f'{parents.name}_pkey',
+        'children table': children.name,
+        'children pkey': f'{children.name}_pkey',
+        'children parent_id index': f'ix_{children.name}_parent_id',
+    }
+    async with engine.connect() as conn:
+        return {label: (await conn.execute(
+                    text('SELECT pg_relation_size(CAST(:name AS regclass))'), {'name': name}
+                )).scalar_one()
+                for label, name in relations.items()}
+
+
+async def _measure(stmts: list, iterations: int) -> list[float]:
+    timings = []
+    async with get_session() as session:
+        for stmt in stmts[:20]:
+            (await session.execute(stmt)).fetchall()  # warm up
+        for i in range(iterations):
+            stmt = stmts[i % len(stmts)]
+            start = time.perf_counter()
+            (await session.execute(stmt)).fetchall()
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _report(storage: str, name: str, timings: list[float]) -> None:
+    quantiles = statistics.quantiles(timings, n=100)
+    print(f'{storage:<8} {name:<8} p50={quantiles[49] * 1000:.3f}ms '
+          f'p95={quantiles[94] * 1000:.3f}ms mean={statistics.fmean(timings) * 1000:.3f}ms')
+
+
+async def main(rows: int, children_per_row: int, in_size: int,
+               iterations: int, seed: int) -> None:
+    rng = random.Random(seed)
+    ids = _ulids(rng, rows)
+    child_ids = _ulids(rng, rows * children_per_row)
+    samples = [rng.sample(ids, in_size) for _ in range(min(iterations, 100))]
+
+    for storage, as_uuid in STORAGES.items():
+        parents, children = _tables(storage, as_uuid)
+        try:
+            await _fill(parents, children, as_uuid, ids, child_ids, children_per_row)
+            for label, size in (await _sizes(parents, children)).items():
+                print(f'{storage:<8} {label:<26} {size / 2 ** 20:.2f} MiB')
+            _report(storage, 'by id', await _measure(
+                [select(parents).where(parents.c.id == sample[0]) for sample in samples],
+                iterations))
+            _report(storage, 'in', await _measure(
+                [select(parents).where(parents.c.id.in_(sample)) for sample in samples],
+                iterations))
+            _report(storage, 'join', await _measure(
+                [select(parents.c.id, children.c.id)
+                 .join(children, children.c.parent_id == parents.c.id)
+                 .where(parents.c.id.in_(sample)) for sample in samples],
+                iterations))
+        finally:
+            async with engine.begin() as conn:
+                await conn.run_sync(parents.metadata.drop_all)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--children-per-row', type=int, default=5)
+    parser.add_argument('--in-size', type=int, default=50, help='ids per IN filter and join')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(rows=args.rows, children_per_row=args.children_per_row,
+                     in_size=args.in_size, iterations=args.iterations, seed=args.seed))
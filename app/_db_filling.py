@@ -1,76 +1,167 @@
+"""
+Fills the database with generated users, libraries and bans for development
+and load tests.
+
+Rows are generated lazily and streamed into the tables in batches with the
+PostgreSQL COPY protocol (asyncpg copy_records_to_table), bypassing the ORM.
+Every user gets the same password, hashed once. Book ids are taken from the
+Books service when it is reachable, otherwise they are generated locally.
+
+Run from the app directory:
+    python _db_filling.py --users 100000 --seed 42
+"""
+
+import argparse
 import asyncio
+import random
+import re
+import time
 from datetime import datetime, timedelta
+from itertools import batched
+from typing import Iterable, Iterator
 
-from db.base import get_session
-from db.crud import create_user, create_library, create_ban
+from config import SelfService
+from db.base import _db_init, engine
+from db.migrations import backfill
+from db.models import Ban, Library, User
+from db.passwords import pwd_context
+from db.types import to_storage
 from faker import Faker
-from patisson_request.service_routes import BooksRoute
 from patisson_request.graphql.queries import QBook
-from config import SelfService
-from db.models import User, Library, Ban
-from sqlalchemy.future import select
-import random
+from patisson_request.roles import ClientRole
+from patisson_request.service_routes import BooksRoute
+from sqlalchemy import func, select
+from ulid import ULID
+
+PASSWORD = 'QweQwe123!'
+
+USER_COLUMNS = ['id', 'username', 'password', 'first_name', 'last_name', 'avatar', 'about', 'role']
+LIBRARY_COLUMNS = ['id', 'book_id', 'user_id', 'status']
+BAN_COLUMNS = ['id', 'user_id', 'reason', 'comment', 'end_date']
+KEY_COLUMNS = {'id', 'user_id'}  # COPY bypasses db.types.ULIDKey
+
+
+class Generator:
+
+    def __init__(self, seed: int) -> None:
+        self.rng = random.Random(seed)
+        self.fake = Faker()
+        self.fake.seed_instance(seed)
+        self._timestamp = int(time.time() * 1000)
+
+    def ulid(self) -> str:
+        self._timestamp += 1
+        return str(ULID.from_bytes(
+            self._timestamp.to_bytes(6, 'big') + self.rng.randbytes(10)))
+
+    def name(self) -> str:
+        name = re.sub('[^A-Za-z]', '', self.fake.first_name())
+        return name if len(name) >= 2 else 'Anna'
+
+    def users(self, count: int, start: int, password_hash: str) -> Iterator[tuple]:
+        for i in range(start, start + count):
+            first_name, last_name = self.name(), self.name()
+            yield (
+                self.ulid(), f'{(first_name + "usr")[:12]}{i}', password_hash,
+                first_name.capitalize(), last_name.capitalize(), None,
+                self.fake.text(max_nb_chars=200), ClientRole.MEMBER.name
+            )
+
+    def libraries(self, user_ids: Iterable[str], book_ids: list[str],
+                  max_per_user: int) -> Iterator[tuple]:
+        statuses = [status.name for status in Library.Status]
+        for user_id in user_ids:
+            count = self.rng.randint(0, min(max_per_user, len(book_ids)))
+            for book_id in self.rng.sample(book_ids, count):
+                yield (self.ulid(), book_id, user_id, self.rng.choice(statuses))
+
+    def bans(self, user_ids: list[str], ratio: float) -> Iterator[tuple]:
+        reasons = [reason.name for reason in Ban.Reason]
+        now = datetime.now()
+        for user_id in self.rng.sample(user_ids, int(len(user_ids) * ratio)):
+            yield (
+                self.ulid(), user_id, self.rng.choice(reasons),
+                self.fake.text(max_nb_chars=100),
+                now + timedelta(days=self.rng.randint(-30, 30), seconds=1)
+            )
+
+
+async def _book_ids(generator: Generator, local_count: int) -> list[str]:
+    try:
+        qbooks = await SelfService.post_request(
+            *-BooksRoute.graphql.books(fields=[QBook.id], limit=0)
+        )
+        book_ids = [book.id for book in qbooks.body.data.books]
+        if book_ids:
+            return book_ids
+    except Exception as e:
+        print(f'the Books service is unavailable ({e!r}), generating book ids locally')
+    return [generator.ulid() for _ in range(local_count)]
+
+
+async def _copy(table: str, columns: list[str], records: Iterable[tuple],
+                batch_size: int) -> int:
+    keys = [i for i, column in enumerate(columns) if column in KEY_COLUMNS]
+    records = (tuple(to_storage(value) if i in keys else value for i, value in enumerate(record))
+               for record in records)
+    count = 0
+    start = time.perf_counter()
+    async with engine.connect() as conn:
+        raw_connection = await conn.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+        for batch in batched(records, batch_size):
+            await driver_connection.copy_records_to_table(  # type: ignore[reportOptionalMemberAccess]
+                table, records=batch, columns=columns)
+            count += len(batch)
+    elapsed = time.perf_counter() - start
+    print(f'{table}: {count} rows in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} rows/s)')
+    return count
+
+
+async def main(users_count: int, libraries_per_user: int, bans_ratio: float,
+               books_count: int, batch_size: int, seed: int) -> None:
+    await _db_init()
+    generator = Generator(seed)
+    async with engine.connect() as conn:
+        existing_users = (await conn.execute(
+            select(func.count()).select_from(User))).scalar_one()
+
+    user_ids: list[str] = []
+    def remember(records: Iterator[tuple]) -> Iterator[tuple]:
+        for record in records:
+            user_ids.append(record[0])
+            yield record
+
+    await _copy('users', USER_COLUMNS, remember(generator.users(
+        users_count, start=existing_users, password_hash=pwd_context.hash(PASSWORD))), batch_size)
+
+    if libraries_per_user > 0:
+        book_ids = await _book_ids(generator, books_count)
+        await _copy('libraries', LIBRARY_COLUMNS, generator.libraries(
+            user_ids, book_ids, libraries_per_user), batch_size)
+
+    if bans_ratio > 0:
+        await _copy('bans', BAN_COLUMNS, generator.bans(user_ids, bans_ratio), batch_size)
+        await backfill()  # COPY bypasses crud, which maintains users.banned_until
+    await engine.dispose()
+
 
-fake = Faker()
-
-async def _create_users(count: int):
-    tasks = []
-    for _ in range(count):
-        async with get_session() as session:
-            tasks.append(create_user(
-                session=session,
-                username=fake.user_name(),
-                password='QweQwe123!',
-                first_name=fake.first_name(),
-                last_name=fake.last_name(),
-                about=fake.text(),
-                role='_'
-            ))
-    await asyncio.gather(*tasks)
-
-
-async def _create_library():
-    qbooks = await SelfService.post_request(
-        *-BooksRoute.graphql.books(fields=[QBook.id], limit=0) 
-    )
-    async with get_session() as session:
-        users_stmt = await session.execute(select(User.id))
-        users = users_stmt.scalars().unique().all()
-    
-    tasks = []
-    for user in users:
-        for _ in range(random.randint(1, 10)):
-            async with get_session() as session:
-                tasks.append(create_library(
-                    session, book_id=random.choice(qbooks.body.data.books).id, 
-                    user_id=user, status=Library.Status(random.randint(0, 2))))
-    await asyncio.gather(*tasks)
-        
-
-async def _create_ban():
-    async with get_session() as session:
-        users_stmt = await session.execute(select(User.id))
-        users = users_stmt.scalars().unique().all()
-    
-    tasks = []
-    for user in random.choices(users, k=int(len(users)/10)):
-        async with get_session() as session:
-            tasks.append(create_ban(
-                session, user_id=user, reason=Ban.Reason(random.randint(0, 0)), 
-                comment=fake.text(), end_date=(datetime.now() 
-                    + timedelta(days=random.randint(0, 30))))
-                         )
-    await asyncio.gather(*tasks)
-        
-
-async def main(users_count: int):
-    await _create_users(count=users_count)
-    await _create_library()
-    await _create_ban()
-    
-    
 if __name__ == "__main__":
-    create_users_count = 100
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100, help='users to create')
+    parser.add_argument('--libraries-per-user', type=int, default=10,
+                        help='the maximum number of library entries per user')
+    parser.add_argument('--bans-ratio', type=float, default=0.1, help='the share of banned users')
+    parser.add_argument('--books', type=int, default=1000,
+                        help='book ids to generate when the Books service is unavailable')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows per COPY')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
     asyncio.run(main(
-        users_count=create_users_count
-    ))
\ No newline at end of file
+        users_count=args.users,
+        libraries_per_user=args.libraries_per_user,
+        bans_ratio=args.bans_ratio,
+        books_count=args.books,
+        batch_size=args.batch_size,
+        seed=args.seed
+    ))
@@ -0,0 +1,80 @@
+"""
+This module caches the client token verification done by the Authentication
+service, so repeated verifications of the same token skip the HTTP round trip.
+
+Entries are keyed by the SHA-256 of the token (the token itself is never kept),
+live no longer than the token's own exp and CLIENT_TOKEN_CACHE_TTL, and are
+evicted in LRU order. Rejected tokens are cached for CLIENT_TOKEN_NEGATIVE_TTL.
+Concurrent lookups of the same token share a single upstream request.
+
+Functions:
+    verify_client_token_remote: Verifies the client token through the Authentication service.
+    invalidate_client_token: Drops the cached verification of the client token.
+"""
+
+import hashlib
+import time
+from datetime import datetime
+from typing import Any, Optional
+
+import config
+from api.upstream import authentication
+from cache import TTLCache
+from patisson_request.service_routes import AuthenticationRoute
+from singleflight import SingleFlight
+
+client_token_cache: TTLCache[bytes, Any] = TTLCache(
+    'users_client_token',
+    maxsize=config.CLIENT_TOKEN_CACHE_SIZE,
+    ttl=config.CLIENT_TOKEN_CACHE_TTL
+)
+client_token_verifications: SingleFlight[bytes, Any] = SingleFlight('users_client_token')
+
+
+def _token_ttl(response: Any) -> Optional[float]:
+    if not response.body.is_verify:
+        return config.CLIENT_TOKEN_NEGATIVE_TTL
+    exp = getattr(response.body.payload, 'exp', None)
+    if exp is None:
+        return None
+    if isinstance(exp, datetime):
+        exp = exp.timestamp()
+    return float(exp) - time.time()
+
+
+def _token_key(access_token: str) -> bytes:
+    return hashlib.sha256(access_token.encode()).digest()
+
+
+async def _verify(key: bytes, access_token: str) -> Any:
+    response = await authentication.call(
+        'jwt.verify', -AuthenticationRoute.api.v1.client.jwt.verify(access_token))
+    client_token_cache.set(key, response, ttl=_token_ttl(response))
+    return response
+
+
+async def verify_client_token_remote(access_token: str) -> Any:
+    """
+    Verifies the client token through the Authentication service.
+
+    Args:
+        access_token (str): The client access token.
+
+    Returns:
+        The response of AuthenticationRoute.api.v1.client.jwt.verify,
+        either cached or fresh.
+
+    Notes:
+        A token revoked upstream may still be accepted until its cache entry
+        expires, so CLIENT_TOKEN_CACHE_TTL bounds that window.
+    """
+    key = _token_key(access_token)
+    response = client_token_cache.get(key)
+    if response is not None:
+        return response
+
+    return await client_token_verifications.do(key, lambda: _verify(key, access_token))
+
+
+def invalidate_client_token(access_token: str) -> None:
+    client_token_cache.invalidate(_token_key(access_token))
@@ -12,6 +12,7 @@ from patisson_request.depends import (dep_opentelemetry_client_decorator,
 from patisson_request.errors import ErrorCode, ErrorSchema, InvalidJWT
 from patisson_request.jwt_tokens import (ClientAccessTokenPayload,
                                          ServiceAccessTokenPayload)
+from profiling import profile_phase
 from sqlalchemy.ext.asyncio import AsyncSession
 
 security = HTTPBearer()
@@ -23,8 +24,9 @@ async def verify_service_token(
     ) -> ServiceAccessTokenPayload:
     token = credentials.credentials
     try:
-        payload = await verify_service_token_dep(
-            self_service=config.SelfService, access_token=token)
+        with profile_phase('deps.verify_service_token'):
+            payload = await verify_service_token_dep(
+                self_service=config.SelfService, access_token=token)
     except InvalidJWT as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -49,15 +51,30 @@ async def verify_serice__user_reg__token(
     return payload
 
 
+async def verify_service__profiles__token(
+    payload: ServiceAccessTokenPayload = Depends(verify_service_token)
+    ) -> ServiceAccessTokenPayload:
+    # profiles hold request paths and stacks, only the listed services may read them
+    if payload.sub not in config.PROFILING_SERVICES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=[ErrorSchema(
+                error=ErrorCode.ACCESS_ERROR
+                ).model_dump()]
+            )
+    return payload
+
+
 @dep_opentelemetry_client_decorator(tracer)
 async def verify_user_token(
     X_Client_Token: str = Header(...)
     ) -> ClientAccessTokenPayload:
     try:
-        payload = await verify_client_token_dep(
-            self_service=config.SelfService,
-            access_token=X_Client_Token
-        )
+        with profile_phase('deps.verify_user_token'):
+            payload = await verify_client_token_dep(
+                self_service=config.SelfService,
+                access_token=X_Client_Token
+            )
     except InvalidJWT as e:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -102,6 +119,7 @@ SessionDep = Annotated[AsyncSession, Depends(get_session)]
 
 ServiceJWT = Annotated[ServiceAccessTokenPayload, Depends(verify_service_token)]
 UserReg_ServiceJWT = Annotated[ServiceAccessTokenPayload, Depends(verify_serice__user_reg__token)]
+Profiles_ServiceJWT = Annotated[ServiceAccessTokenPayload, Depends(verify_service__profiles__token)]
 
 UserJWT = Annotated[ClientAccessTokenPayload, Depends(verify_user_token)]
 CreateBan_UserJWT = Annotated[ClientAccessTokenPayload, Depends(verify_user__create_ban__token)]
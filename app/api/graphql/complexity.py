@@ -0,0 +1,266 @@
+"""
+This module guards the GraphQL endpoint: it resolves persisted queries and
+rejects documents that are invalid or too expensive before any resolver runs.
+
+Parsed and validated documents are kept in an LRU cache keyed by the SHA-256
+of the query, and api.graphql.route executes the cached document, so a
+repeated query is neither parsed nor validated again. The same hash is the persisted query ID: a client may send only
+extensions.persistedQuery.sha256Hash (the Apollo automatic persisted queries
+protocol), a hash unknown to the service is answered with
+PERSISTED_QUERY_NOT_FOUND and the client retries with the full query, which
+registers it. Queries listed in GRAPHQL_PERSISTED_QUERIES_FILE are always
+known, and GRAPHQL_PERSISTED_QUERIES_ONLY rejects any other query.
+
+The cost analysis runs against the variables of every request and enforces
+GRAPHQL_MAX_DEPTH, GRAPHQL_MAX_LIST_SIZE (list arguments such as ids),
+GRAPHQL_MAX_LIMIT, GRAPHQL_MAX_OFFSET and GRAPHQL_MAX_COST, where the cost of
+a field is 1 plus the cost of its selection times the number of items it may
+return.
+
+Classes:
+    QueryPlan: A parsed document with its validation errors.
+
+Functions:
+    query_hash: Returns the persisted query ID of a query.
+    get_plan: Returns the cached plan of a query, parsing and validating it on a miss.
+    check_complexity: Checks the depth, list sizes, limits and cost of an operation.
+    check_request: Resolves the query of a request and runs the checks.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Iterator, NamedTuple, Optional
+
+import config
+from cache import TTLCache
+from graphql import (DocumentNode, FieldNode, FragmentDefinitionNode,
+                     FragmentSpreadNode, GraphQLError, GraphQLObjectType,
+                     InlineFragmentNode, SelectionSetNode, build_schema,
+                     get_named_type, get_nullable_type, is_list_type, parse,
+                     validate)
+from graphql.execution.values import get_argument_values, get_variable_values
+from graphql.utilities import get_operation_ast
+from metrics import Counter
+from starlette.responses import JSONResponse, Response
+
+SCHEMA_PATH = os.path.join(os.path.dirname(config.__file__), config.PATH_TO_GSCHEMA.lstrip('/'))
+PERSISTED_QUERY_NOT_FOUND = 'PERSISTED_QUERY_NOT_FOUND'
+
+with open(SCHEMA_PATH) as file:
+    schema = build_schema(file.read())
+
+graphql_rejected = Counter(
+    'users_graphql_rejected_total',
+    'GraphQL requests rejected before execution by reason',
+    labelnames=('reason',)
+)
+
+
+class QueryPlan(NamedTuple):
+    query: str
+    document: Optional[DocumentNode]
+    errors: tuple[GraphQLError, ...]
+
+
+plans: TTLCache[str, QueryPlan] = TTLCache(
+    'users_graphql_documents',
+    maxsize=config.GRAPHQL_DOCUMENT_CACHE_SIZE,
+    ttl=config.GRAPHQL_DOCUMENT_CACHE_TTL
+)
+
+
+def _load_persisted_queries(path: str) -> dict[str, str]:
+    if not path:
+        return {}
+    with open(path) as file:
+        queries = json.load(file)
+    # the file may list the queries alone or map them by their IDs
+    if isinstance(queries, list):
+        queries = {query_hash(query): query for query in queries}
+    return queries
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+persisted_queries = _load_persisted_queries(config.GRAPHQL_PERSISTED_QUERIES_FILE)
+
+
+def get_plan(query: str, hash_: Optional[str] = None) -> QueryPlan:
+    hash_ = hash_ or query_hash(query)
+    plan = plans.get(hash_)
+    if plan is None:
+        try:
+            document = parse(query)
+        except GraphQLError as e:
+            plan = QueryPlan(query, None, (e,))
+        else:
+            plan = QueryPlan(query, document, tuple(validate(schema, document)))
+        plans.set(hash_, plan)
+    return plan
+
+
+def _resolve_query(data: dict[str, Any]) -> tuple[Optional[QueryPlan], Optional[GraphQLError]]:
+    '''
+    Returns the plan of the query of the request body, looked up by
+    its persisted query ID when the body carries one
+    '''
+    query = data.get('query')
+    persisted = (data.get('extensions') or {}).get('persistedQuery') or {}
+    hash_ = persisted.get('sha256Hash')
+
+    if hash_ is None:
+        if not isinstance(query, str):
+            return None, None  # left to the executor to report
+        hash_ = query_hash(query)
+        if config.GRAPHQL_PERSISTED_QUERIES_ONLY and hash_ not in persisted_queries:
+            return None, GraphQLError('Only persisted queries are allowed',
+                                      extensions={'code': 'PERSISTED_QUERY_REQUIRED'})
+        return get_plan(query, hash_), None
+
+    if query is None:
+        query = persisted_queries.get(hash_)
+        if query is None:
+            plan = plans.get(hash_)
+            if plan is None:
+                return None, GraphQLError('PersistedQueryNotFound',
+                                          extensions={'code': PERSISTED_QUERY_NOT_FOUND})
+            return plan, None
+    elif query_hash(query) != hash_:
+        return None, GraphQLError('The query does not match its sha256Hash',
+                                  extensions={'code': 'PERSISTED_QUERY_HASH_MISMATCH'})
+    elif config.GRAPHQL_PERSISTED_QUERIES_ONLY and hash_ not in persisted_queries:
+        return None, GraphQLError('Only persisted queries are allowed',
+                                  extensions={'code': 'PERSISTED_QUERY_REQUIRED'})
+    return get_plan(query, hash_), None
+
+
+class _CostAnalysis:
+
+    def __init__(self, document: DocumentNode, variables: dict[str, Any]) -> None:
+        self.variables = variables
+        self.fragments = {
+            definition.name.value: definition for definition in document.definitions
+            if isinstance(definition, FragmentDefinitionNode)
+        }
+        self.errors: list[GraphQLError] = []
+
+    def _fields(self, selection_set: SelectionSetNode, visited: set[str]) -> Iterator[FieldNode]:
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                yield selection
+            elif isinstance(selection, InlineFragmentNode):
+                yield from self._fields(selection.selection_set, visited)
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                if name not in visited and name in self.fragments:
+                    yield from self._fields(self.fragments[name].selection_set, visited | {name})
+
+    def _check_arguments(self, field_node: FieldNode, arguments: dict[str, Any]) -> None:
+        for name, value in arguments.items():
+            if isinstance(value, list) and len(value) > config.GRAPHQL_MAX_LIST_SIZE:
+                self.errors.append(GraphQLError(
+                    f'The argument {name} of {field_node.name.value} has {len(value)} items, '
+                    f'the maximum is {config.GRAPHQL_MAX_LIST_SIZE}', field_node))
+        limit = arguments.get('limit')
+        if 'limit' in arguments and limit is None:  # an explicit null lifts the resolver default
+            self.errors.append(GraphQLError(
+                f'The limit of {field_node.name.value} must not be null', field_node))
+        elif limit is not None and not 0 <= limit <= config.GRAPHQL_MAX_LIMIT:
+            self.errors.append(GraphQLError(
+                f'The limit of {field_node.name.value} must be between 0 and '
+                f'{config.GRAPHQL_MAX_LIMIT}', field_node))
+        offset = arguments.get('offset')
+        if offset is not None and not 0 <= offset <= config.GRAPHQL_MAX_OFFSET:
+            self.errors.append(GraphQLError(
+                f'The offset of {field_node.name.value} must be between 0 and '
+                f'{config.GRAPHQL_MAX_OFFSET}, use the after cursor instead', field_node))
+
+    def cost(self, parent_type: GraphQLObjectType, selection_set: SelectionSetNode,
+             depth: int, page_size: Optional[int] = None) -> int:
+        if depth > config.GRAPHQL_MAX_DEPTH:
+            self.errors.append(GraphQLError(
+                f'The query is deeper than {config.GRAPHQL_MAX_DEPTH} levels', selection_set))
+            return 0
+        total = 0
+        for field_node in self._fields(selection_set, set()):
+            field_def = parent_type.fields.get(field_node.name.value)
+            if field_def is None:  # __typename and the like
+                continue
+            try:
+                arguments = get_argument_values(field_def, field_node, self.variables)
+            except GraphQLError as e:
+                self.errors.append(e)
+                continue
+            self._check_arguments(field_node, arguments)
+
+            # the number of items requested from a list field (or the items of a page)
+            size = arguments.get('limit')
+            if size is None and arguments.get('ids'):
+                size = len(arguments['ids'])
+
+            field_type = get_named_type(field_def.type)
+            is_list = is_list_type(get_nullable_type(field_def.type))
+            child = 0
+            if field_node.selection_set and isinstance(field_type, GraphQLObjectType):
+                child = self.cost(field_type, field_node.selection_set, depth + 1,
+                                  page_size=None if is_list else size)
+            if is_list:
+                items = size or page_size or config.GRAPHQL_DEFAULT_LIST_SIZE
+                total += 1 + items * child
+            else:
+                total += 1 + child
+        return total
+
+
+def check_complexity(document: DocumentNode, variables: Optional[dict[str, Any]],
+                     operation_name: Optional[str] = None) -> list[GraphQLError]:
+    '''
+    Checks the depth, list sizes, limits and cost of the operation to be
+    executed, an empty list means the operation may run
+    '''
+    operation = get_operation_ast(document, operation_name)
+    if operation is None or operation.operation.value != 'query':
+        return []  # left to the executor to report
+    coerced = get_variable_values(schema, operation.variable_definitions or (), variables or {})
+    if isinstance(coerced, list):
+        return coerced
+
+    analysis = _CostAnalysis(document, coerced)
+    cost = analysis.cost(schema.query_type, operation.selection_set, depth=1)  # type: ignore[reportArgumentType]
+    if cost > config.GRAPHQL_MAX_COST:
+        analysis.errors.append(GraphQLError(
+            f'The query cost {cost} exceeds the maximum of {config.GRAPHQL_MAX_COST}',
+            operation, extensions={'code': 'QUERY_TOO_COMPLEX', 'cost': cost}))
+    return analysis.errors
+
+
+def _errors_response(errors: list[GraphQLError] | tuple[GraphQLError, ...],
+                     reason: str) -> Response:
+    graphql_rejected.labels(reason).inc()
+    return JSONResponse({'errors': [error.formatted for error in errors]}, status_code=400)
+
+
+def check_request(data: dict[str, Any]) -> tuple[Optional[QueryPlan], Optional[Response]]:
+    '''
+    Resolves the persisted query of the request body and runs the checks. 
+    Returns the plan to execute (None leaves the body to the executor 
+    to report) or the response rejecting the request. The query of the 
+    plan is put into the body, as a persisted query may have been sent 
+    by its ID alone
+    '''
+    plan, error = _resolve_query(data)
+    if error is not None:
+        return None, _errors_response([error], 'persisted_query')
+    if plan is None:
+        return None, None
+    if plan.errors:
+        return None, _errors_response(plan.errors, 'invalid')
+    errors = check_complexity(plan.document, data.get('variables'),  # type: ignore[reportArgumentType]
+                              data.get('operationName'))
+    if errors:
+        return None, _errors_response(errors, 'complexity')
+    data['query'] = plan.query
+    return plan, None
@@ -9,14 +9,16 @@ Functions:
     verify_tokens_decorator: A decorator to verify service and client tokens for GraphQL resolvers.
 """
 
+import asyncio
 import inspect
 from functools import wraps
+from typing import Any, Awaitable, Callable
 
 import config
+from api.graphql.route import RequestContext
 from fastapi.security import HTTPBearer
 from graphql import GraphQLError, GraphQLResolveInfo
 from opentelemetry import trace
-from patisson_graphql.framework_utils.fastapi import GraphQLContext
 from patisson_request.depends import (dep_opentelemetry_client_decorator,
                                       dep_opentelemetry_service_decorator,
                                       verify_client_token_dep,
@@ -29,12 +31,12 @@ security = HTTPBearer()
 tracer = trace.get_tracer(__name__)
 
 @dep_opentelemetry_service_decorator(tracer)
-async def verify_service_token(context: GraphQLContext) -> ServiceAccessTokenPayload:
+async def verify_service_token(context: RequestContext) -> ServiceAccessTokenPayload:
     """
     Verifies the service token from the request headers.
 
     Args:
-        context (GraphQLContext): The GraphQL context containing the request.
+        context (RequestContext): The GraphQL context containing the request.
 
     Returns:
         ServiceAccessTokenPayload: The decoded service token payload.
@@ -67,12 +69,12 @@ async def verify_service_token(context: GraphQLContext) -> ServiceAccessTokenPay
 
 
 @dep_opentelemetry_client_decorator(tracer)
-async def verify_client_token(context: GraphQLContext) -> ClientAccessTokenPayload:
+async def verify_client_token(context: RequestContext) -> ClientAccessTokenPayload:
     """
     Verifies the client token from the request headers.
 
     Args:
-        context (GraphQLContext): The GraphQL context containing the request.
+        context (RequestContext): The GraphQL context containing the request.
 
     Returns:
         ClientAccessTokenPayload: The decoded client token payload.
@@ -102,6 +104,24 @@ async def verify_client_token(context: GraphQLContext) -> ClientAccessTokenPaylo
             },
         )
     return payload
+
+
+
+def _verified(context: RequestContext, name: str,
+              verify: Callable[[RequestContext], Awaitable[Any]]) -> 'asyncio.Future[Any]':
+    '''
+    Returns the verification of the token for the current request, so every token
+    is verified once per request however many resolvers need it. The task is
+    memoized rather than the payload, so concurrent resolvers share the pending
+    verification, and an invalid token raises the same error in each of them
+    '''
+    state = context.request.state
+    if not hasattr(state, 'verified_tokens'):
+        state.verified_tokens = {}
+    task = state.verified_tokens.get(name)
+    if task is None:
+        task = state.verified_tokens[name] = asyncio.ensure_future(verify(context))
+    return task
         
         
 def verify_tokens_decorator(func):
@@ -118,17 +138,22 @@ def verify_tokens_decorator(func):
         This decorator checks the function signature for the presence of 'service_token' and
         'user_token' arguments and automatically verifies the corresponding tokens before calling
         the resolver. The verified tokens are passed to the resolver as arguments.
+        The signature is inspected once, at decoration time, and the verified
+        payloads are memoized for the lifetime of the request.
     """
+    func_signature_arguments = inspect.signature(func).parameters
+    needs_service_token = 'service_token' in func_signature_arguments
+    needs_client_token = 'client_token' in func_signature_arguments
     
     @wraps(func)
     async def wrapper(root, info: GraphQLResolveInfo, **kwargs):
-        func_signature_arguments = [param.name for param in 
-                                    inspect.signature(func).parameters.values()]
-        func_kwargs = {}
-        if (service:='service_token') in func_signature_arguments: 
-            func_kwargs[service] = await verify_service_token(info.context)
-        if (user:='client_token') in func_signature_arguments: 
-            func_kwargs[user] = await verify_client_token(info.context)
-        return await func(root, info, **func_kwargs, **kwargs)
+        if needs_service_token: 
+            # looked up at call time, so the verifiers can be replaced (e.g. in benchmarks)
+            kwargs['service_token'] = await _verified(
+                info.context, 'service_token', verify_service_token)
+        if needs_client_token: 
+            kwargs['client_token'] = await _verified(
+                info.context, 'client_token', verify_client_token)
+        return await func(root, info, **kwargs)
     
     return wrapper
\ No newline at end of file
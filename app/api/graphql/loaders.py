@@ -0,0 +1,81 @@
+"""
+This module contains a per-request DataLoader used to resolve nested GraphQL
+fields without N+1 queries.
+
+Every key requested during one tick of the event loop is collected and
+passed to the batch function at once, which is expected to resolve all of
+them with a single IN query. Loaders (and the lock serializing their use of
+the request's db_session) live on the request state, so nothing is shared
+between requests.
+
+Classes:
+    DataLoader: Batches and caches loads by key.
+
+Functions:
+    get_loader: Returns the loader of the current request, creating it on first use.
+    session_lock: Returns the lock guarding the db_session of the current request.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from graphql import GraphQLResolveInfo
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class DataLoader(Generic[K, V]):
+    """
+    Batches and caches loads by key.
+
+    Args:
+        batch_load (Callable[[list[K]], Awaitable[list[V]]]): Resolves a list
+            of unique keys, the values must be in the order of the keys.
+    """
+
+    def __init__(self, batch_load: Callable[[list[K]], Awaitable[list[V]]]) -> None:
+        self._batch_load = batch_load
+        self._futures: dict[K, asyncio.Future[V]] = {}
+        self._queue: list[K] = []
+
+    def load(self, key: K) -> 'asyncio.Future[V]':
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            if not self._queue:
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+            self._queue.append(key)
+        return future
+
+    async def _dispatch(self) -> None:
+        keys, self._queue = self._queue, []
+        try:
+            values = await self._batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                if not self._futures[key].done():
+                    self._futures[key].set_exception(e)
+            return
+        for key, value in zip(keys, values):
+            if not self._futures[key].done():
+                self._futures[key].set_result(value)
+
+
+def session_lock(info: GraphQLResolveInfo) -> asyncio.Lock:
+    state = info.context.request.state
+    if not hasattr(state, 'db_session_lock'):
+        state.db_session_lock = asyncio.Lock()
+    return state.db_session_lock
+
+
+def get_loader(info: GraphQLResolveInfo, name: Hashable,
+               batch_load: Callable[[list], Awaitable[list]]) -> DataLoader:
+    state = info.context.request.state
+    if not hasattr(state, 'dataloaders'):
+        state.dataloaders = {}
+    loader = state.dataloaders.get(name)
+    if loader is None:
+        loader = state.dataloaders[name] = DataLoader(batch_load)
+    return loader
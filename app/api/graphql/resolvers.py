@@ -1,44 +1,77 @@
-from typing import Optional
+from datetime import datetime
+from itertools import groupby
+from typing import Callable, Optional
 
+import config
 from api.graphql.deps import verify_tokens_decorator
-from ariadne import QueryType
-from config import logger
-from db.crud import users_ban_subquery
-from db.models import Library, User
-from graphql import GraphQLResolveInfo
-from patisson_graphql.framework_utils.fastapi import GraphQLContext
+from api.graphql.loaders import get_loader, session_lock
+from api.graphql.route import RequestContext
+from ariadne import ObjectType, QueryType
+from config import lazy, logger
+from db.crud import (get_users_status, query_results_cache,
+                     users_is_banned_column)
+from db.models import Ban, Library, User
+from metrics import Histogram, timed
+from graphql import FieldNode, GraphQLResolveInfo
 from patisson_graphql.selected_fields import selected_fields
 from patisson_graphql.stmt_filter import Stmt
 from patisson_request.jwt_tokens import ServiceAccessTokenPayload
+from sqlalchemy import func
 from sqlalchemy.future import select
 
 query = QueryType()
+user = ObjectType("User")
 
+graphql_resolver_latency = Histogram(
+    'users_graphql_resolver_seconds',
+    'Latency of the GraphQL resolvers (batched loads for the nested User fields)',
+    labelnames=('resolver',)
+)
 
-@query.field("users")
-@verify_tokens_decorator
-async def users(_, info: GraphQLResolveInfo, 
-                service_token: ServiceAccessTokenPayload,
+
+def _page_info(info: GraphQLResolveInfo, field_name: str = 'items') -> GraphQLResolveInfo:
+    """
+    Narrows the resolve info of a *_page query to its nested list field, 
+    so selected_fields sees the fields of the items instead of the page.
+    """
+    field_nodes = [
+        selection 
+        for field_node in info.field_nodes if field_node.selection_set
+        for selection in field_node.selection_set.selections
+        if isinstance(selection, FieldNode) and selection.name.value == field_name
+    ]
+    return info._replace(field_nodes=field_nodes)
+
+
+def _page(rows: list, limit: Optional[int]) -> dict:
+    next_cursor = rows[-1].id if limit and len(rows) == limit else None
+    return {'items': rows, 'next_cursor': next_cursor}
+
+
+def _users_stmt(info: GraphQLResolveInfo,
                 ids: Optional[list[str]] = None,
                 usernames: Optional[list[str]] = None,
                 first_names: Optional[list[str]] = None,
                 last_names: Optional[list[str]] = None,
                 roles: Optional[list[str]] = None,
                 is_banned: Optional[bool] = None,
+                after: Optional[str] = None,
                 offset: Optional[int] = None,
-                limit: Optional[int] = 10):
-    context: GraphQLContext[ServiceAccessTokenPayload, None] = info.context
-    
+                limit: Optional[int] = 10) -> Stmt:
     stmt_selected_fields = selected_fields(info, User)
+    # the id is the page cursor and the key of the nested User fields
+    if not any(field is User.id for field in stmt_selected_fields):
+        stmt_selected_fields.append(User.id)
     is_banned_field = None
     if is_banned is not None:
-        is_banned_field = users_ban_subquery()
+        is_banned_field = users_is_banned_column()
         stmt_selected_fields.append(is_banned_field)  # type: ignore[reportArgumentType]
-        
-    stmt = (
-        Stmt(
-            select(*stmt_selected_fields)
-            )
+    
+    select_stmt = select(*stmt_selected_fields)
+    if after is not None:
+        select_stmt = select_stmt.where(User.id > after)
+    return (
+        Stmt(select_stmt)
         .con_filter(User.id, ids)
         .con_filter(User.username, usernames)
         .con_filter(User.first_name, first_names)
@@ -47,36 +80,199 @@ async def users(_, info: GraphQLResolveInfo,
         .where_filter(is_banned_field, is_banned)  # type: ignore[reportArgumentType]
         .offset(offset).limit(limit).ordered_by(User.id)
     )
-    logger.info(stmt.log())
-    result = await context.db_session.execute(stmt())
-    return result.fetchall()
 
 
-@query.field("libraries")
-@verify_tokens_decorator
-async def libraries(_, info: GraphQLResolveInfo,
-                    service_token: ServiceAccessTokenPayload,
+def _libraries_stmt(info: GraphQLResolveInfo,
                     ids: Optional[list[str]] = None,
                     user_ids: Optional[list[str]] = None,
                     book_ids: Optional[list[str]] = None,
                     statuses: Optional[list[str]] = None,
+                    after: Optional[str] = None,
                     offset: Optional[int] = None,
-                    limit: Optional[int] = 10):
-    context: GraphQLContext[ServiceAccessTokenPayload, None] = info.context
-    
+                    limit: Optional[int] = 10,
+                    with_id: bool = False) -> Stmt:
     stmt_selected_fields = selected_fields(info, Library)
-    stmt = (
-        Stmt(
-            select(*stmt_selected_fields)
-            )
+    if with_id and not any(field is Library.id for field in stmt_selected_fields):
+        stmt_selected_fields.append(Library.id)
+    
+    select_stmt = select(*stmt_selected_fields)
+    if after is not None:
+        select_stmt = select_stmt.where(Library.id > after)
+    return (
+        Stmt(select_stmt)
         .con_filter(Library.id, ids)
         .con_filter(Library.user_id, user_ids)
         .con_filter(Library.book_id, book_ids)
         .con_filter(Library.status, statuses)
         .offset(offset).limit(limit).ordered_by(Library.id)
     )
-    logger.info(stmt.log())
-    result = await context.db_session.execute(stmt())
-    return result.fetchall()
 
-resolvers = [query]
\ No newline at end of file
+
+def _normalized(kwargs: dict) -> tuple:
+    # the results are ordered by id, so neither the order nor duplicates of the list items matter
+    return tuple(sorted(
+        (name, tuple(sorted(set(value), key=str)) if isinstance(value, list) else value)
+        for name, value in kwargs.items() if value is not None
+    ))
+
+
+def _users_tags(kwargs: dict) -> list[str]:
+    filters = {name for name, value in kwargs.items() 
+               if value is not None and name not in ('after', 'offset', 'limit')}
+    if filters == {'ids'}:
+        return [f'users:{user_id}' for user_id in kwargs['ids']]
+    return ['users']
+
+
+def _libraries_tags(kwargs: dict) -> list[str]:
+    if kwargs.get('user_ids') is not None:
+        return [f'libraries:{user_id}' for user_id in kwargs['user_ids']]
+    return ['libraries']
+
+
+async def _fetch_all(info: GraphQLResolveInfo, key: tuple, tags: list[str], 
+                     stmt: Callable[[], Stmt]) -> list:
+    """
+    Executes the statement, going through query_results_cache when it is enabled.
+    
+    Notes:
+        The key must cover everything the statement depends on: the resolver,
+        its normalized arguments and the selected fields.
+    """
+    cache_enabled = config.QUERY_RESULTS_CACHE_SIZE > 0
+    if cache_enabled:
+        rows = query_results_cache.get(key)
+        if rows is not None:
+            return rows
+        versions = query_results_cache.versions(tags)
+    
+    context: RequestContext = info.context
+    stmt_ = stmt()
+    logger.info('%s', lazy(stmt_.log))
+    async with session_lock(info):
+        result = await context.db_session.execute(stmt_())
+    rows = result.fetchall()
+    
+    if cache_enabled and len(rows) <= config.QUERY_RESULTS_CACHE_MAX_ROWS:
+        query_results_cache.set(key, rows, versions)  # type: ignore[reportPossiblyUnboundVariable]
+    return rows
+
+
+@query.field("users")
+@verify_tokens_decorator
+@timed(graphql_resolver_latency, 'Query.users')
+async def users(_, info: GraphQLResolveInfo, 
+                service_token: ServiceAccessTokenPayload,
+                **kwargs):
+    return await _fetch_all(
+        info, ('users', _normalized(kwargs), _projection_key(info, User)),
+        _users_tags(kwargs), lambda: _users_stmt(info, **kwargs)
+    )
+
+
+@query.field("users_page")
+@verify_tokens_decorator
+@timed(graphql_resolver_latency, 'Query.users_page')
+async def users_page(_, info: GraphQLResolveInfo, 
+                     service_token: ServiceAccessTokenPayload,
+                     limit: Optional[int] = 10,
+                     **kwargs):
+    page_info = _page_info(info)
+    rows = await _fetch_all(
+        info, ('users_page', limit, _normalized(kwargs), _projection_key(page_info, User)),
+        _users_tags(kwargs), lambda: _users_stmt(page_info, limit=limit, **kwargs)
+    )
+    return _page(rows, limit)
+
+
+@query.field("libraries")
+@verify_tokens_decorator
+@timed(graphql_resolver_latency, 'Query.libraries')
+async def libraries(_, info: GraphQLResolveInfo,
+                    service_token: ServiceAccessTokenPayload,
+                    **kwargs):
+    return await _fetch_all(
+        info, ('libraries', _normalized(kwargs), _projection_key(info, Library)),
+        _libraries_tags(kwargs), lambda: _libraries_stmt(info, **kwargs)
+    )
+
+
+@query.field("libraries_page")
+@verify_tokens_decorator
+@timed(graphql_resolver_latency, 'Query.libraries_page')
+async def libraries_page(_, info: GraphQLResolveInfo,
+                         service_token: ServiceAccessTokenPayload,
+                         limit: Optional[int] = 10,
+                         **kwargs):
+    page_info = _page_info(info)
+    rows = await _fetch_all(
+        info, ('libraries_page', limit, _normalized(kwargs), _projection_key(page_info, Library)),
+        _libraries_tags(kwargs), 
+        lambda: _libraries_stmt(page_info, limit=limit, with_id=True, **kwargs)
+    )
+    return _page(rows, limit)
+
+async def _load_by_user_id(info: GraphQLResolveInfo, model, user_ids: list[str],
+                           limit: int) -> list[list]:
+    '''
+    Loads the first (by id) limit rows of every user in one query
+    '''
+    stmt_selected_fields = selected_fields(info, model)
+    if not any(field is model.user_id for field in stmt_selected_fields):
+        stmt_selected_fields.append(model.user_id)
+    ranked = (
+        select(*stmt_selected_fields, 
+               func.row_number().over(partition_by=model.user_id, order_by=model.id).label('rank'))
+        .where(model.user_id.in_(user_ids))
+        .subquery()
+    )
+    stmt = (
+        select(*(column for column in ranked.c if column.key != 'rank'))
+        .where(ranked.c.rank <= limit)
+        .order_by(ranked.c.user_id, ranked.c.rank)
+    )
+    async with session_lock(info):
+        with graphql_resolver_latency.labels(f'User.{model.__tablename__}').time():
+            result = await info.context.db_session.execute(stmt)
+    rows = {user_id: list(group) 
+            for user_id, group in groupby(result.fetchall(), key=lambda row: row.user_id)}
+    return [rows.get(user_id, []) for user_id in user_ids]
+
+
+def _projection_key(info: GraphQLResolveInfo, model) -> tuple:
+    return (model.__tablename__, 
+            tuple(str(field) for field in selected_fields(info, model)))
+
+
+# limit defaults to 10 in the schema, an explicit null is rejected by api.graphql.complexity
+@user.field("libraries")
+async def user_libraries(parent, info: GraphQLResolveInfo, limit: int):
+    loader = get_loader(
+        info, (_projection_key(info, Library), limit),
+        lambda user_ids: _load_by_user_id(info, Library, user_ids, limit)
+    )
+    return await loader.load(parent.id)
+
+
+@user.field("bans")
+async def user_bans(parent, info: GraphQLResolveInfo, limit: int):
+    loader = get_loader(
+        info, (_projection_key(info, Ban), limit),
+        lambda user_ids: _load_by_user_id(info, Ban, user_ids, limit)
+    )
+    return await loader.load(parent.id)
+
+
+@user.field("isBanned")
+async def user_is_banned(parent, info: GraphQLResolveInfo):
+    async def batch_load(user_ids: list[str]) -> list[bool]:
+        async with session_lock(info):
+            with graphql_resolver_latency.labels('User.isBanned').time():
+                statuses = await get_users_status(info.context.db_session, user_ids)
+        now = datetime.now()
+        return [banned_until is not None and banned_until > now 
+                for _, banned_until in (statuses[user_id] for user_id in user_ids)]
+    
+    return await get_loader(info, 'is_banned', batch_load).load(parent.id)
+
+resolvers = [query, user]
\ No newline at end of file
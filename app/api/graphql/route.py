@@ -0,0 +1,118 @@
+"""
+This module contains the GraphQL endpoint of the service.
+
+Queries are executed with ariadne's graphql() behind the checks of
+api.graphql.complexity. The executor gets the document the checks have taken
+from their cache (query_parser) and reuses its validation (query_validator),
+so a repeated or persisted query is parsed and validated once per
+GRAPHQL_DOCUMENT_CACHE_TTL rather than on every request.
+
+Every request gets its own database session from the session factory, shared
+by its resolvers (see api.graphql.loaders.session_lock).
+
+Classes:
+    RequestContext: The context passed to the resolvers.
+
+Functions:
+    create_graphql_route: Returns the GraphQL endpoint.
+"""
+
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, Callable, Optional
+
+from api.graphql.complexity import SCHEMA_PATH, QueryPlan, check_request
+from ariadne import SchemaBindable, graphql, make_executable_schema
+from ariadne.utils import convert_camel_case_to_snake
+from graphql import (DocumentNode, GraphQLError, GraphQLObjectType,
+                     GraphQLResolveInfo, GraphQLSchema, parse, specified_rules,
+                     validate)
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+
+@dataclass
+class RequestContext:
+    request: Request
+    db_session: AsyncSession
+
+
+def _resolve_attribute(parent: Any, info: GraphQLResolveInfo, **kwargs) -> Any:
+    '''
+    Reads the field from a row or a dict by its name, or by its snake_case
+    name (firstName -> first_name) for the columns of camelCase fields
+    '''
+    name = info.field_name
+    if isinstance(parent, dict):
+        return parent.get(name, parent.get(convert_camel_case_to_snake(name)))
+    value = getattr(parent, name, None)
+    if value is None:
+        value = getattr(parent, convert_camel_case_to_snake(name), None)
+    return value
+
+
+def _executable_schema(resolvers: list[SchemaBindable]) -> GraphQLSchema:
+    with open(SCHEMA_PATH) as file:
+        schema = make_executable_schema(file.read(), *resolvers)
+    for type_ in schema.type_map.values():
+        if isinstance(type_, GraphQLObjectType) and not type_.name.startswith('__'):
+            for field in type_.fields.values():
+                if field.resolve is None:
+                    field.resolve = _resolve_attribute
+    return schema
+
+
+def create_graphql_route(resolvers: list[SchemaBindable],
+                         session_factory: Callable[[], AsyncContextManager[AsyncSession]]
+                         ) -> Callable[[Request], Any]:
+    """
+    Returns the GraphQL endpoint.
+
+    Args:
+        resolvers (list[SchemaBindable]): The bindables of the schema, e.g. api.graphql.resolvers.resolvers.
+        session_factory (Callable[[], AsyncContextManager[AsyncSession]]): Opens the session
+            of a request, e.g. db.base.get_read_session.
+
+    Returns:
+        Callable[[Request], Awaitable[Response]]: The endpoint, to be added as a POST route.
+    """
+    schema = _executable_schema(resolvers)
+
+    async def graphql_route(request: Request) -> Response:
+        try:
+            data = await request.json()
+        except ValueError:
+            return JSONResponse({'errors': [{'message': 'The request body is not valid JSON'}]},
+                                status_code=400)
+
+        plan: Optional[QueryPlan] = None
+        if isinstance(data, dict):
+            plan, rejection = check_request(data)
+            if rejection is not None:
+                return rejection
+
+        def parse_query(context: Any, data_: dict[str, Any]) -> DocumentNode:
+            if plan is not None:
+                return plan.document  # type: ignore[reportReturnType]
+            return parse(data_['query'])
+
+        def validate_query(schema_: GraphQLSchema, document: DocumentNode,
+                           rules: Any = None, max_errors: Optional[int] = None,
+                           type_info: Any = None, **kwargs) -> list[GraphQLError]:
+            # the plan has been validated against the same schema with the specified rules
+            if (plan is not None and document is plan.document
+                    and tuple(rules or specified_rules) == tuple(specified_rules)):
+                return list(plan.errors)
+            return validate(schema_, document, rules=rules, max_errors=max_errors,
+                            type_info=type_info)
+
+        async with session_factory() as session:
+            success, result = await graphql(
+                schema, data,
+                context_value=RequestContext(request, session),
+                query_parser=parse_query,
+                query_validator=validate_query,
+            )
+        return JSONResponse(result, status_code=200 if success else 400)
+
+    return graphql_route
@@ -0,0 +1,92 @@
+"""
+This module exposes the service metrics to Prometheus.
+
+Classes:
+    MetricsMiddleware: ASGI middleware observing the latency of every HTTP request.
+
+Functions:
+    upstream_call: Observes the latency of a request to another service.
+    metrics_route: Renders the registered metrics in the Prometheus text format.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from metrics import Counter, Histogram, render
+from profiling import profile_phase
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+request_latency = Histogram(
+    'users_http_request_seconds',
+    'HTTP request latency by route template and method',
+    labelnames=('route', 'method')
+)
+upstream_latency = Histogram(
+    'users_upstream_request_seconds',
+    'Latency of the requests to other services by service and route',
+    labelnames=('service', 'route')
+)
+request_errors = Counter(
+    'users_http_request_errors_total',
+    'HTTP responses with a 5xx status by route template and method',
+    labelnames=('route', 'method')
+)
+
+
+@contextmanager
+def upstream_call(service: str, route: str) -> Iterator[None]:
+    with upstream_latency.labels(service, route).time(), profile_phase(f'upstream.{route}'):
+        yield
+
+
+def _route_template(scope: Scope) -> str:
+    route = scope.get('route')
+    if route is not None:
+        return route.path
+    if 'endpoint' in scope:
+        # plain Starlette routes (e.g. /graphql) don't set scope['route'], 
+        # they are added without path parameters, so the path is bounded
+        return scope['path']
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of every HTTP request.
+
+    Notes:
+        Requests are labelled with the route template (e.g. /users/api/v1/verify-user)
+        rather than the raw path, so the number of series stays bounded;
+        requests that matched no route are labelled 'unmatched'.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            labels = (_route_template(scope), scope['method'])
+            request_latency.labels(*labels).observe(time.perf_counter() - start)
+            if status_code >= 500:
+                request_errors.labels(*labels).inc()
+
+
+async def metrics_route(request: Request) -> Response:
+    return Response(render(), media_type='text/plain; version=0.0.4; charset=utf-8')
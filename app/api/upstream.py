@@ -0,0 +1,172 @@
+"""
+This module contains the layer the calls to other services go through.
+
+Every call waits for one of the UPSTREAM_MAX_CONCURRENCY slots of its service,
+then gets the timeout of its route (UPSTREAM_TIMEOUTS, UPSTREAM_TIMEOUT by
+default) for the request itself; a call that can't get a slot within the same
+timeout fails as saturated. The calls pass a circuit breaker: after
+UPSTREAM_BREAKER_FAILURES consecutive failures of the requests (timeouts,
+transport errors) the calls fail fast for UPSTREAM_BREAKER_RESET seconds, then
+a single probe call decides whether the circuit closes again. Error responses
+of the service (e.g. an invalid token) and saturation are not failures.
+
+Calls are sent with config.SelfService.post_request, looked up at call time,
+so a fake of the service (see _benchmarks.suite) can be swapped in.
+
+Classes:
+    UpstreamUnavailable: The service can't be called (timeout, open circuit, transport error, saturation).
+    CircuitBreaker: Fails fast after consecutive failures.
+    Upstream: The calls to one service.
+"""
+
+import asyncio
+import time
+from typing import Any
+
+import config
+from api.telemetry import upstream_call
+from fastapi import HTTPException, status
+from metrics import Counter, Gauge
+
+upstream_failures = Counter(
+    'users_upstream_failures_total',
+    'Failed requests to other services by service, route and reason',
+    labelnames=('service', 'route', 'reason')
+)
+upstream_circuit_open = Gauge(
+    'users_upstream_circuit_open',
+    '1 while the circuit breaker of the service is open',
+    labelnames=('service',)
+)
+
+
+class UpstreamUnavailable(HTTPException):
+
+    def __init__(self, service: str, route: str, reason: str) -> None:
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f'the {service} service is unavailable ({route}: {reason})'
+        )
+        self.service = service
+        self.route = route
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """
+    Fails fast after consecutive failures.
+
+    Args:
+        failures (int): Consecutive failures opening the circuit.
+        reset_timeout (float): Seconds the circuit stays open before a probe call.
+    """
+
+    def __init__(self, failures: int, reset_timeout: float) -> None:
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> tuple[bool, bool]:
+        '''
+        Returns whether the call may go through and whether it is 
+        the probe of a half-open circuit; only the probe settles it
+        '''
+        if self.opened_at is None:
+            return True, False
+        if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False, False
+        self._probing = True  # half-open: a single call goes through
+        return True, True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release_probe(self, is_probe: bool) -> None:
+        if is_probe:
+            self._probing = False  # the probe didn't reach the service, let the next call probe
+
+    def record_failure(self, is_probe: bool) -> None:
+        self.consecutive_failures += 1
+        if is_probe or self.consecutive_failures >= self.failures:
+            self.opened_at = time.monotonic()
+        if is_probe:
+            self._probing = False
+
+
+class Upstream:
+    """
+    The calls to one service.
+
+    Args:
+        service (str): The name of the service, used in the metrics and errors.
+    """
+
+    def __init__(self, service: str) -> None:
+        self.service = service
+        self.semaphore = asyncio.Semaphore(config.UPSTREAM_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker(config.UPSTREAM_BREAKER_FAILURES, config.UPSTREAM_BREAKER_RESET)
+
+    def _fail(self, route: str, reason: str) -> UpstreamUnavailable:
+        upstream_failures.labels(self.service, route, reason).inc()
+        upstream_circuit_open.labels(self.service).set(int(self.breaker.is_open))
+        return UpstreamUnavailable(self.service, route, reason)
+
+    async def call(self, route: str, request: Any) -> Any:
+        """
+        Sends the request through config.SelfService.post_request.
+
+        Args:
+            route (str): The route name, e.g. 'jwt.verify', selects the timeout.
+            request: The route object of patisson_request, e.g.
+                -AuthenticationRoute.api.v1.client.jwt.verify(token).
+
+        Returns:
+            The response of post_request.
+
+        Raises:
+            UpstreamUnavailable: On a timeout, a transport error, an open circuit
+                or no free slot within the timeout.
+        """
+        allowed, is_probe = self.breaker.allow()
+        if not allowed:
+            raise self._fail(route, 'circuit_open')
+        timeout = config.UPSTREAM_TIMEOUTS.get(route, config.UPSTREAM_TIMEOUT)
+        try:
+            async with asyncio.timeout(timeout):
+                await self.semaphore.acquire()
+        except BaseException as e:
+            # a local backlog says nothing about the service, not a breaker failure
+            self.breaker.release_probe(is_probe)
+            if isinstance(e, TimeoutError):
+                raise self._fail(route, 'saturated') from None
+            raise
+        try:
+            async with asyncio.timeout(timeout):
+                with upstream_call(self.service, route):
+                    response = await config.SelfService.post_request(*request)
+        except TimeoutError:
+            self.breaker.record_failure(is_probe)
+            raise self._fail(route, 'timeout') from None
+        except asyncio.CancelledError:
+            self.breaker.release_probe(is_probe)
+            raise
+        except Exception as e:
+            self.breaker.record_failure(is_probe)
+            config.logger.warning('the request to %s (%s) failed: %r', self.service, route, e)
+            raise self._fail(route, 'error') from e
+        finally:
+            self.semaphore.release()
+        self.breaker.record_success()
+        upstream_circuit_open.labels(self.service).set(0)
+        return response
+
+
+authentication = Upstream('authentication')
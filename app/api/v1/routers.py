@@ -1,17 +1,36 @@
+import asyncio
+import enum
+import json
+from typing import Any, AsyncIterator, Optional
+
 import config
-from api.deps import (CreateBan_UserJWT, CreateLib_UserJWT, ServiceJWT,
-                      SessionDep, UserReg_ServiceJWT)
-from config import logger
-from db.crud import create_ban, create_library, create_user, get_active_user
-from db.models import Ban, Library
-from fastapi import APIRouter, Header, HTTPException, status
-from patisson_request.errors import ErrorSchema
+from api.client_tokens import (invalidate_client_token,
+                               verify_client_token_remote)
+from api.deps import (CreateBan_UserJWT, CreateLib_UserJWT,
+                      Profiles_ServiceJWT, ServiceJWT, SessionDep,
+                      UserReg_ServiceJWT)
+from api.upstream import authentication
+from api.v1.schemas import (BulkCreateResponse, BulkCreateResult,
+                            CreateBansRequest, CreateLibrariesRequest,
+                            CreateUsersRequest, RevokeBanRequest,
+                            VerifyUsersRequest, VerifyUsersResponse)
+from config import lazy, logger
+from db.base import get_read_session
+from db.crud import (EXPORT_FIELDS, BulkResult, check_active_user,
+                     check_active_users, create_ban, create_bans,
+                     create_libraries, create_library, create_user,
+                     create_users, revoke_ban, stream_export)
+from db.models import Ban, Library, User
+from fastapi import APIRouter, Header, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from patisson_request.errors import ErrorCode, ErrorSchema
 from patisson_request.roles import ClientRole
 from patisson_request.service_requests import UsersRequest
 from patisson_request.service_responses import (SuccessResponse,
                                                 TokensSetResponse,
                                                 VerifyUserResponse)
 from patisson_request.service_routes import AuthenticationRoute
+from profiling import recent_profiles
 
 router = APIRouter()
 
@@ -33,21 +52,22 @@ async def create_user_route(service: UserReg_ServiceJWT,
             )
      
     if is_valid:
-        response = await config.SelfService.post_request(
-            *-AuthenticationRoute.api.v1.client.jwt.create(
+        response = await authentication.call(
+            'jwt.create', 
+            -AuthenticationRoute.api.v1.client.jwt.create(
                 client_id=str(body.id),  # type: ignore[reportAttributeAccessIssue]
                 client_role=ClientRole(str(body.role)),  # type: ignore[reportAttributeAccessIssue]
                 expire_in=user.expire_in
             )
         )
-        logger.info(f'user {body.id} has been created, service initiator {service.sub}')  # type: ignore[reportAttributeAccessIssue]
+        logger.info('user %s has been created, service initiator %s', body.id, service.sub)  # type: ignore[reportAttributeAccessIssue]
         return TokensSetResponse(
             access_token=response.body.access_token,
             refresh_token=response.body.refresh_token
         )
         
     else:
-        logger.info(str(body) + f'service initiator {service.sub}')
+        logger.info('%s service initiator %s', body, service.sub)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail=[body.model_dump()]
@@ -66,10 +86,10 @@ async def create_library_route(service: ServiceJWT, user: CreateLib_UserJWT,
             user_id=library.user_id, 
             status=Library.Status(library.status))
     if is_valid:
-        logger.info(f'user {user.sub} has been created a library {body.id}, service initiator {service.sub}')  # type: ignore[reportAttributeAccessIssue]
+        logger.info('user %s has been created a library %s, service initiator %s', user.sub, body.id, service.sub)  # type: ignore[reportAttributeAccessIssue]
         return SuccessResponse()
     else:
-        logger.info(str(body) + f'service initiator {service.sub}')
+        logger.info('%s service initiator %s', body, service.sub)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail=[body.model_dump()]
@@ -89,51 +109,180 @@ async def create_ban_route(service: ServiceJWT, user: CreateBan_UserJWT,
             end_date=ban.end_date
             )
     if is_valid:
-        logger.info(f'user {user.sub} has been created a ban {body.id}, service initiator {service.sub}')  # type: ignore[reportAttributeAccessIssue]
+        logger.info('user %s has been created a ban %s, service initiator %s', user.sub, body.id, service.sub)  # type: ignore[reportAttributeAccessIssue]
         return SuccessResponse()
     else:
-        logger.info(str(body) + f'service initiator {service.sub}')
+        logger.info('%s service initiator %s', body, service.sub)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, 
             detail=[body.model_dump()]
             )
     
     
+@router.post('/revoke-ban')
+async def revoke_ban_route(service: ServiceJWT, user: CreateBan_UserJWT, 
+                           session: SessionDep, request: RevokeBanRequest
+                           ) -> SuccessResponse:
+    async with session as session_: 
+        is_valid, body = await revoke_ban(session=session_, ban_id=request.ban_id)
+    if is_valid:
+        logger.info('user %s has revoked the ban %s of the user %s, service initiator %s', 
+                    user.sub, request.ban_id, body, service.sub)
+        return SuccessResponse()
+    else:
+        logger.info('%s service initiator %s', body, service.sub)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, 
+            detail=[body.model_dump()]  # type: ignore[reportAttributeAccessIssue]
+            )
+    
+    
+def _bulk_response(results: BulkResult) -> BulkCreateResponse:
+    return BulkCreateResponse(results=[
+        BulkCreateResult(is_success=True, id=str(body.id))  # type: ignore[reportAttributeAccessIssue]
+        if is_valid else BulkCreateResult(is_success=False, error=body)  # type: ignore[reportArgumentType]
+        for is_valid, body in results
+    ])
+
+
+@router.post('/create-users')
+async def create_users_route(service: UserReg_ServiceJWT, 
+                             session: SessionDep, request: CreateUsersRequest
+                             ) -> BulkCreateResponse:
+    async with session as session_:
+        results = await create_users(
+            session=session_,
+            role=ClientRole.MEMBER.name,
+            users=[dict(
+                username=user.username, 
+                password=user.password, 
+                first_name=user.first_name, 
+                last_name=user.last_name, 
+                avatar=user.avatar, 
+                about=user.about
+                ) for user in request.users]
+            )
+    created = sum(is_valid for is_valid, _ in results)
+    logger.info('%s/%s users have been created, service initiator %s', created, len(results), service.sub)
+    return _bulk_response(results)
+
+
+@router.post('/create-libraries')
+async def create_libraries_route(service: ServiceJWT, user: CreateLib_UserJWT, 
+                                 session: SessionDep, request: CreateLibrariesRequest
+                                 ) -> BulkCreateResponse:
+    async with session as session_:
+        results = await create_libraries(
+            session=session_,
+            libraries=[dict(
+                book_id=library.book_id,
+                user_id=library.user_id, 
+                status=Library.Status(library.status)
+                ) for library in request.libraries]
+            )
+    created = sum(is_valid for is_valid, _ in results)
+    logger.info('user %s has been created %s/%s libraries, service initiator %s', user.sub, created, len(results), service.sub)
+    return _bulk_response(results)
+
+
+@router.post('/create-bans')
+async def create_bans_route(service: ServiceJWT, user: CreateBan_UserJWT, 
+                            session: SessionDep, request: CreateBansRequest
+                            ) -> BulkCreateResponse:
+    async with session as session_:
+        results = await create_bans(
+            session=session_,
+            bans=[dict(
+                user_id=ban.user_id,
+                reason=Ban.Reason(ban.reason),
+                comment=ban.comment,
+                end_date=ban.end_date
+                ) for ban in request.bans]
+            )
+    created = sum(is_valid for is_valid, _ in results)
+    logger.info('user %s has been created %s/%s bans, service initiator %s', user.sub, created, len(results), service.sub)
+    return _bulk_response(results)
+    
+    
 @router.post('/verify-user')
-async def verify_user_route(service: ServiceJWT, session: SessionDep, 
+async def verify_user_route(service: ServiceJWT, 
                             request: UsersRequest.VerifyUser
                             ) -> VerifyUserResponse:
-    response = await config.SelfService.post_request(
-        *-AuthenticationRoute.api.v1.client.jwt.verify(request.access_token)
-    )
+    response = await verify_client_token_remote(request.access_token)
     if not response.body.is_verify:
-        logger.info(response.body.error.error + f'service initiator {service.sub}')  # type: ignore[reportOptionalMemberAccess]
+        logger.info('%s service initiator %s', response.body.error.error, service.sub)  # type: ignore[reportOptionalMemberAccess]
         return VerifyUserResponse(is_verify=False, payload=None, error=ErrorSchema(
             error=response.body.error.error  # type: ignore[reportOptionalMemberAccess]
         ))
     
-    async with session as session_:
-        is_valid, body = await get_active_user(
+    user_id = response.body.payload.sub  # type: ignore[reportOptionalMemberAccess]
+    async with get_read_session(user_id) as session_:
+        is_valid, body = await check_active_user(
             session=session_,
-            user_id=response.body.payload.sub  # type: ignore[reportOptionalMemberAccess]
+            user_id=user_id
         )
     
     if is_valid:
-        logger.info(f'service {service.sub} verified user {response.body.payload.sub}')  # type: ignore[reportOptionalMemberAccess]
+        logger.info('service %s verified user %s', service.sub, user_id)
         return VerifyUserResponse(is_verify=True, payload=response.body.payload)
     
-    logger.info(str(body) + f'service initiator {service.sub}')
+    logger.info('%s service initiator %s', body, service.sub)
     return VerifyUserResponse(is_verify=False, payload=None, error=body)
 
 
+@router.post('/verify-users')
+async def verify_users_route(service: ServiceJWT, 
+                             request: VerifyUsersRequest
+                             ) -> VerifyUsersResponse:
+    semaphore = asyncio.Semaphore(config.VERIFY_USERS_CONCURRENCY)
+    
+    async def verify(access_token: str):
+        async with semaphore:
+            return await verify_client_token_remote(access_token)
+    
+    responses = await asyncio.gather(
+        *(verify(access_token) for access_token in request.access_tokens),
+        return_exceptions=True
+    )
+    for response in responses:
+        # as in /verify-user: the Authentication service being unavailable 
+        # (UpstreamUnavailable, 503) says nothing about the tokens
+        if isinstance(response, BaseException):
+            raise response
+    
+    results: list[VerifyUserResponse | None] = [None] * len(responses)
+    verified: list[int] = []
+    for i, response in enumerate(responses):
+        if not response.body.is_verify:  # type: ignore[reportAttributeAccessIssue]
+            results[i] = VerifyUserResponse(is_verify=False, payload=None, error=ErrorSchema(
+                error=response.body.error.error  # type: ignore[reportOptionalMemberAccess]
+            ))
+        else:
+            verified.append(i)
+    
+    if verified:
+        user_ids = [responses[i].body.payload.sub for i in verified]  # type: ignore[reportAttributeAccessIssue]
+        async with get_read_session(*user_ids) as session_:
+            checks = await check_active_users(
+                session=session_,
+                user_ids=user_ids
+            )
+        for i, (is_valid, body) in zip(verified, checks):
+            if is_valid:
+                results[i] = VerifyUserResponse(is_verify=True, payload=responses[i].body.payload)  # type: ignore[reportAttributeAccessIssue]
+            else:
+                results[i] = VerifyUserResponse(is_verify=False, payload=None, error=body)
+    
+    logger.info('service %s verified %s/%s tokens in a batch', service.sub, len(verified), len(results))
+    return VerifyUsersResponse(results=results)  # type: ignore[reportArgumentType]
+
+
 @router.post('/update-user')
 async def update_user_route(service: ServiceJWT, body: UsersRequest.UpdateUser, 
-                            session: SessionDep, X_Client_Token: str = Header(...)
+                            X_Client_Token: str = Header(...)
                             ) -> TokensSetResponse:
     
-    verify_response = await config.SelfService.post_request(
-        *-AuthenticationRoute.api.v1.client.jwt.verify(X_Client_Token)
-    )
+    verify_response = await verify_client_token_remote(X_Client_Token)
     if not verify_response.body.is_verify:
        raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -142,31 +291,111 @@ async def update_user_route(service: ServiceJWT, body: UsersRequest.UpdateUser,
                 ).model_dump()
             )
        
-    async with session as session_:
-        is_valid, body_= await get_active_user(
+    user_id = verify_response.body.payload.sub  # type: ignore[reportOptionalMemberAccess]
+    async with get_read_session(user_id) as session_:
+        is_valid, body_= await check_active_user(
             session=session_,
-            user_id=verify_response.body.payload.sub  # type: ignore[reportOptionalMemberAccess]
+            user_id=user_id
         )
     
     if not is_valid:
-        logger.info(str(body) + f'service initiator {service.sub}')
+        logger.info('%s service initiator %s', body_, service.sub)
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=body_.model_dump()
             )
         
-    update_response = await config.SelfService.post_request(
-        *-AuthenticationRoute.api.v1.client.jwt.update(
+    update_response = await authentication.call(
+        'jwt.update',
+        -AuthenticationRoute.api.v1.client.jwt.update(
             client_access_token=X_Client_Token,
             client_refresh_token=body.refresh_token
             )
         )
     if update_response.is_error:
-        logger.info(str(update_response.body.model_dump()) + f'service initiator {service.sub}')
+        logger.info('%s service initiator %s', lazy(update_response.body.model_dump), service.sub)
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=update_response.body.model_dump()
         )
+    invalidate_client_token(X_Client_Token)
     
-    logger.info(f'service {service.sub} has updated user ({verify_response.body.payload.sub}) tokens')  # type: ignore[reportOptionalMemberAccess]
-    return update_response.body
\ No newline at end of file
+    logger.info('service %s has updated user (%s) tokens', service.sub, user_id)
+    return update_response.body
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, enum.Enum):
+        return value.name
+    return str(value)
+
+
+def _export_response(model: type[User] | type[Library], service_sub: str,
+                     fields: Optional[list[str]], filters: dict[str, Optional[list[str]]],
+                     is_banned: Optional[bool] = None) -> StreamingResponse:
+    allowed_fields = EXPORT_FIELDS[model]
+    fields = fields or list(allowed_fields)
+    unknown_fields = [field for field in fields if field not in allowed_fields]
+    if unknown_fields:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=ErrorSchema(
+                error=ErrorCode.INVALID_PARAMETERS,
+                extra=f'unknown fields {unknown_fields}, the fields are {list(allowed_fields)}'
+            ).model_dump()
+        )
+    
+    async def ndjson() -> AsyncIterator[bytes]:
+        rows_count = 0
+        async for rows in stream_export(model, fields, filters, is_banned):  # type: ignore[reportArgumentType]
+            rows_count += len(rows)
+            yield ''.join(json.dumps(row, default=_json_default) + '\n' for row in rows).encode()
+        logger.info('service %s exported %s %s', service_sub, rows_count, model.__tablename__)
+    
+    return StreamingResponse(ndjson(), media_type='application/x-ndjson')
+
+
+@router.get('/export-users')
+async def export_users_route(service: ServiceJWT,
+                             fields: Optional[list[str]] = Query(None),
+                             ids: Optional[list[str]] = Query(None),
+                             usernames: Optional[list[str]] = Query(None),
+                             first_names: Optional[list[str]] = Query(None),
+                             last_names: Optional[list[str]] = Query(None),
+                             roles: Optional[list[str]] = Query(None),
+                             is_banned: Optional[bool] = None
+                             ) -> StreamingResponse:
+    return _export_response(User, service.sub, fields, {
+        'id': ids, 'username': usernames, 'first_name': first_names,
+        'last_name': last_names, 'role': roles
+    }, is_banned)
+
+
+@router.get('/export-libraries')
+async def export_libraries_route(service: ServiceJWT,
+                                 fields: Optional[list[str]] = Query(None),
+                                 ids: Optional[list[str]] = Query(None),
+                                 user_ids: Optional[list[str]] = Query(None),
+                                 book_ids: Optional[list[str]] = Query(None),
+                                 statuses: Optional[list[str]] = Query(None)
+                                 ) -> StreamingResponse:
+    unknown_statuses = [status_ for status_ in statuses or [] 
+                        if status_ not in Library.Status.__members__]
+    if unknown_statuses:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=ErrorSchema(
+                error=ErrorCode.INVALID_PARAMETERS,
+                extra=f'unknown statuses {unknown_statuses}'
+            ).model_dump()
+        )
+    return _export_response(Library, service.sub, fields, {
+        'id': ids, 'user_id': user_ids, 'book_id': book_ids, 'status': statuses
+    })
+
+
+@router.get('/profiles')
+async def profiles_route(service: Profiles_ServiceJWT,
+                         limit: int = Query(20, ge=1, le=config.PROFILING_KEEP_IN_MEMORY)
+                         ) -> list[dict]:
+    return recent_profiles()[:limit]
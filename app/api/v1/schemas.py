@@ -0,0 +1,46 @@
+"""
+Request and response models of the v1 routes that are specific to the Users
+service and therefore are not part of patisson_request.
+"""
+
+from typing import Optional
+
+import config
+from patisson_request.errors import ErrorSchema
+from patisson_request.service_requests import UsersRequest
+from patisson_request.service_responses import VerifyUserResponse
+from pydantic import BaseModel, Field
+
+
+class VerifyUsersRequest(BaseModel):
+    access_tokens: list[str] = Field(min_length=1, max_length=config.VERIFY_USERS_MAX_TOKENS)
+
+
+class VerifyUsersResponse(BaseModel):
+    results: list[VerifyUserResponse]  # in the order of access_tokens
+
+
+class RevokeBanRequest(BaseModel):
+    ban_id: str
+
+
+class CreateUsersRequest(BaseModel):
+    users: list[UsersRequest.CreateUser] = Field(min_length=1, max_length=config.BULK_CREATE_MAX_ITEMS)
+
+
+class CreateLibrariesRequest(BaseModel):
+    libraries: list[UsersRequest.CreateLibrary] = Field(min_length=1, max_length=config.BULK_CREATE_MAX_ITEMS)
+
+
+class CreateBansRequest(BaseModel):
+    bans: list[UsersRequest.CreateBan] = Field(min_length=1, max_length=config.BULK_CREATE_MAX_ITEMS)
+
+
+class BulkCreateResult(BaseModel):
+    is_success: bool
+    id: Optional[str] = None
+    error: Optional[ErrorSchema] = None
+
+
+class BulkCreateResponse(BaseModel):
+    results: list[BulkCreateResult]  # in the order of the request items
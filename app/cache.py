@@ -0,0 +1,158 @@
+"""
+This module contains a small in-process cache used in front of hot lookups.
+
+Classes:
+    TTLCache: A bounded LRU cache whose entries expire after a time-to-live.
+    TaggedTTLCache: A TTLCache whose entries can be invalidated by tag.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, Iterable, Optional, TypeVar
+
+from metrics import Counter, Gauge
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class TTLCache(Generic[K, V]):
+    """
+    A bounded LRU cache with a per-entry time-to-live.
+
+    Args:
+        name (str): The prefix of the exported metrics, e.g. 'users_user_status'.
+        maxsize (int): The maximum number of entries, the least recently used
+            entry is evicted when it is exceeded.
+        ttl (float): The default time-to-live of an entry in seconds.
+
+    Notes:
+        The cache is not shared between workers, so every worker keeps its own
+        copy and invalidation only affects the worker that performed it.
+        Expiration uses the monotonic clock.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = Counter(f'{name}_cache_hits_total', f'{name} cache hits')
+        self.misses = Counter(f'{name}_cache_misses_total', f'{name} cache misses')
+        self.evictions = Counter(f'{name}_cache_evictions_total', f'{name} cache evictions')
+        self.size = Gauge(f'{name}_cache_size', f'{name} cache entries')
+
+    def get(self, key: K) -> Optional[V]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses.inc()
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.size.set(len(self._data))
+            self.misses.inc()
+            return None
+        self._data.move_to_end(key)
+        self.hits.inc()
+        return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            self.invalidate(key)
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions.inc()
+        self.size.set(len(self._data))
+
+    def invalidate(self, key: K) -> None:
+        if self._data.pop(key, None) is not None:
+            self.size.set(len(self._data))
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size.set(0)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+Versions = tuple[float, tuple[tuple[Hashable, int], ...]]  # (taken at, tag versions)
+
+
+class TaggedTTLCache(Generic[K, V]):
+    """
+    A TTLCache whose entries depend on tags (e.g. 'users:<id>'), invalidating 
+    a tag drops every entry that depends on it.
+
+    Args:
+        name (str): The prefix of the exported metrics.
+        maxsize (int): The maximum number of entries.
+        ttl (float): The time-to-live of an entry in seconds.
+
+    Notes:
+        Invalidation only bumps the version of the tags, an entry is dropped 
+        when it is read with outdated versions, so it costs O(tags) whatever 
+        the number of entries. The versions are taken with versions() before 
+        the value is computed, so a value computed concurrently with 
+        an invalidation is never served. An entry expires ttl seconds after 
+        its versions were taken (a value computed for longer is not stored), 
+        and a bumped version is kept for ttl seconds, so the version of 
+        a tag can't be pruned while an entry that saw the previous one lives.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float) -> None:
+        self.ttl = ttl
+        self._entries: TTLCache[K, tuple[Versions, V]] = TTLCache(name, maxsize, ttl)
+        self._versions: OrderedDict[Hashable, tuple[float, int]] = OrderedDict()
+        self._clock = 0
+        self.stale = Counter(f'{name}_cache_stale_total', f'{name} cache entries dropped by tag')
+
+    def _version(self, tag: Hashable) -> int:
+        item = self._versions.get(tag)
+        return 0 if item is None else item[1]
+
+    def versions(self, tags: Iterable[Hashable]) -> Versions:
+        return time.monotonic(), tuple((tag, self._version(tag)) for tag in tags)
+
+    def _is_current(self, versions: Versions) -> bool:
+        return all(self._version(tag) == version for tag, version in versions[1])
+
+    def get(self, key: K) -> Optional[V]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        versions, value = item
+        if not self._is_current(versions):
+            self._entries.invalidate(key)
+            self.stale.inc()
+            return None
+        return value
+
+    def set(self, key: K, value: V, versions: Versions) -> None:
+        ttl = versions[0] + self.ttl - time.monotonic()
+        if ttl <= 0 or not self._is_current(versions):
+            return  # computed for too long, or invalidated meanwhile
+        self._entries.set(key, (versions, value), ttl=ttl)
+
+    def invalidate_tags(self, *tags: Hashable) -> None:
+        now = time.monotonic()
+        while self._versions:
+            tag, (bumped_at, _) = next(iter(self._versions.items()))
+            if bumped_at + self.ttl > now:
+                break
+            del self._versions[tag]
+        for tag in tags:
+            # versions are never reused, so an older entry of the tag never matches
+            self._clock += 1
+            self._versions[tag] = (now, self._clock)
+            self._versions.move_to_end(tag)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
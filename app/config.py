@@ -1,7 +1,12 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+from typing import Any, Callable, Optional
 
 from dotenv import load_dotenv
+from metrics import Counter
 from patisson_request.core import SelfAsyncService
 from patisson_request.services import Service
 
@@ -9,15 +14,147 @@ root_path = os.path.join(os.path.dirname(__file__), '..')
 
 load_dotenv(dotenv_path=os.path.join(root_path, '.env'))
 
+
+def _getenv_mapping(key: str) -> dict[str, float]:
+    # "jwt.verify=0.5,jwt.create=2"
+    value = os.getenv(key, "")
+    return {name.strip(): float(number) 
+            for name, number in (item.split("=") for item in value.split(",") if item.strip())}
+
+
+def _getenv_bool(key: str, default: bool) -> bool:
+    value = os.getenv(key)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 SERVICE_NAME: str = Service.USERS.value
 SERVICE_HOST: str = os.getenv("SERVICE_HOST")  # type: ignore[reportArgumentType]
 
 DATABASE_URL: str = os.getenv("DATABASE_URL")  # type: ignore[reportArgumentType]
+DATABASE_ECHO: bool = _getenv_bool("DATABASE_ECHO", False)
+DATABASE_POOL_SIZE: int = int(os.getenv("DATABASE_POOL_SIZE", 10))
+DATABASE_MAX_OVERFLOW: int = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+DATABASE_POOL_TIMEOUT: float = float(os.getenv("DATABASE_POOL_TIMEOUT", 30))
+DATABASE_POOL_RECYCLE: int = int(os.getenv("DATABASE_POOL_RECYCLE", 1800))  # seconds, -1 to disable
+DATABASE_POOL_PRE_PING: bool = _getenv_bool("DATABASE_POOL_PRE_PING", True)
+DATABASE_POOL_WARMUP: int = int(os.getenv("DATABASE_POOL_WARMUP", DATABASE_POOL_SIZE))
+DATABASE_STATEMENT_CACHE_SIZE: int = int(os.getenv("DATABASE_STATEMENT_CACHE_SIZE", 100))
+# store the ULID keys as native uuid instead of varchar (see db.types)
+DATABASE_UUID_IDS: bool = _getenv_bool("DATABASE_UUID_IDS", False)
+
+DATABASE_REPLICA_URLS: list[str] = [
+    url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()
+]
+DATABASE_REPLICA_HEALTH_INTERVAL: float = float(os.getenv("DATABASE_REPLICA_HEALTH_INTERVAL", 5))
+DATABASE_REPLICA_HEALTH_TIMEOUT: float = float(os.getenv("DATABASE_REPLICA_HEALTH_TIMEOUT", 2))
+# how long reads about a just written key stay on the primary (read-your-writes)
+DATABASE_REPLICA_PIN_SECONDS: float = float(os.getenv("DATABASE_REPLICA_PIN_SECONDS", 10))
+
+UPSTREAM_TIMEOUT: float = float(os.getenv("UPSTREAM_TIMEOUT", 2))  # seconds
+UPSTREAM_TIMEOUTS: dict[str, float] = _getenv_mapping("UPSTREAM_TIMEOUTS")  # per route, e.g. jwt.verify=0.5
+UPSTREAM_MAX_CONCURRENCY: int = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", 64))  # per service
+UPSTREAM_BREAKER_FAILURES: int = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))
+UPSTREAM_BREAKER_RESET: float = float(os.getenv("UPSTREAM_BREAKER_RESET", 10))  # seconds
 
 EXTERNAL_SERVICES: list[Service] = [Service.AUTHENTICATION, Service.BOOKS]
 
 PATH_TO_GSCHEMA = '/api/graphql/schema.graphql'
 
+GRAPHQL_MAX_DEPTH: int = int(os.getenv("GRAPHQL_MAX_DEPTH", 6))
+GRAPHQL_MAX_LIST_SIZE: int = int(os.getenv("GRAPHQL_MAX_LIST_SIZE", 500))  # items of list arguments (ids, ...)
+GRAPHQL_MAX_LIMIT: int = int(os.getenv("GRAPHQL_MAX_LIMIT", 500))
+GRAPHQL_MAX_OFFSET: int = int(os.getenv("GRAPHQL_MAX_OFFSET", 10_000))
+GRAPHQL_MAX_COST: int = int(os.getenv("GRAPHQL_MAX_COST", 50_000))
+GRAPHQL_DEFAULT_LIST_SIZE: int = int(os.getenv("GRAPHQL_DEFAULT_LIST_SIZE", 10))  # assumed size of unbounded lists
+GRAPHQL_DOCUMENT_CACHE_SIZE: int = int(os.getenv("GRAPHQL_DOCUMENT_CACHE_SIZE", 1000))
+GRAPHQL_DOCUMENT_CACHE_TTL: float = float(os.getenv("GRAPHQL_DOCUMENT_CACHE_TTL", 24 * 60 * 60))
+GRAPHQL_PERSISTED_QUERIES_FILE: str = os.getenv("GRAPHQL_PERSISTED_QUERIES_FILE", "")
+GRAPHQL_PERSISTED_QUERIES_ONLY: bool = _getenv_bool("GRAPHQL_PERSISTED_QUERIES_ONLY", False)
+
+PROFILING_HEADER_ENABLED: bool = _getenv_bool("PROFILING_HEADER_ENABLED", False)
+PROFILING_SAMPLE_RATE: float = float(os.getenv("PROFILING_SAMPLE_RATE", 0))
+PROFILING_SLOW_THRESHOLD: float = float(os.getenv("PROFILING_SLOW_THRESHOLD", 0))  # seconds, 0 to disable
+PROFILING_SAMPLER_INTERVAL: float = float(os.getenv("PROFILING_SAMPLER_INTERVAL", 0))  # seconds, 0 to disable
+PROFILING_SAMPLER_WINDOW: float = float(os.getenv("PROFILING_SAMPLER_WINDOW", 60))  # seconds of samples kept
+PROFILING_DIR: str = os.getenv("PROFILING_DIR", "")
+PROFILING_MAX_FILES: int = int(os.getenv("PROFILING_MAX_FILES", 200))
+PROFILING_KEEP_IN_MEMORY: int = int(os.getenv("PROFILING_KEEP_IN_MEMORY", 100))
+# services (the sub of their token) allowed to read the profiles, none by default
+PROFILING_SERVICES: list[str] = [
+    name.strip() for name in os.getenv("PROFILING_SERVICES", "").split(",") if name.strip()
+]
+
+LOG_LEVEL: Optional[str] = os.getenv("LOG_LEVEL")
+LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", 10_000))
+
+PASSWORD_HASH_EXECUTOR: str = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")  # thread | process
+PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING: int = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32))
+
+USER_STATUS_CACHE_SIZE: int = int(os.getenv("USER_STATUS_CACHE_SIZE", 100_000))
+USER_STATUS_CACHE_TTL: float = float(os.getenv("USER_STATUS_CACHE_TTL", 30))
+
+# the GraphQL users/libraries results, a size of 0 disables the cache
+QUERY_RESULTS_CACHE_SIZE: int = int(os.getenv("QUERY_RESULTS_CACHE_SIZE", 0))
+QUERY_RESULTS_CACHE_TTL: float = float(os.getenv("QUERY_RESULTS_CACHE_TTL", 2))
+QUERY_RESULTS_CACHE_MAX_ROWS: int = int(os.getenv("QUERY_RESULTS_CACHE_MAX_ROWS", 100))  # larger results aren't cached
+
+CLIENT_TOKEN_CACHE_SIZE: int = int(os.getenv("CLIENT_TOKEN_CACHE_SIZE", 100_000))
+CLIENT_TOKEN_CACHE_TTL: float = float(os.getenv("CLIENT_TOKEN_CACHE_TTL", 60))
+CLIENT_TOKEN_NEGATIVE_TTL: float = float(os.getenv("CLIENT_TOKEN_NEGATIVE_TTL", 5))
+
+VERIFY_USERS_MAX_TOKENS: int = int(os.getenv("VERIFY_USERS_MAX_TOKENS", 500))
+VERIFY_USERS_CONCURRENCY: int = int(os.getenv("VERIFY_USERS_CONCURRENCY", 16))
+
+BAN_SWEEP_INTERVAL: float = float(os.getenv("BAN_SWEEP_INTERVAL", 60))  # the longest sleep between sweeps, seconds
+BAN_SWEEP_BATCH_SIZE: int = int(os.getenv("BAN_SWEEP_BATCH_SIZE", 1000))
+BAN_ARCHIVE_AFTER_DAYS: int = int(os.getenv("BAN_ARCHIVE_AFTER_DAYS", 90))  # 0 to keep ended bans
+
+EXPORT_CHUNK_SIZE: int = int(os.getenv("EXPORT_CHUNK_SIZE", 50_000))  # rows per read transaction
+EXPORT_FETCH_SIZE: int = int(os.getenv("EXPORT_FETCH_SIZE", 1000))  # rows per cursor fetch
+
+BULK_CREATE_MAX_ITEMS: int = int(os.getenv("BULK_CREATE_MAX_ITEMS", 5000))
+BULK_INSERT_CHUNK_SIZE: int = int(os.getenv("BULK_INSERT_CHUNK_SIZE", 1000))
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler over a bounded queue that drops records instead of blocking 
+    the event loop when the listener falls behind. Records are enqueued 
+    unformatted, formatting happens in the listener thread
+    '''
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+    
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+class lazy:
+    '''
+    Defers an expensive log argument: logger.info('%s', lazy(stmt.log)) 
+    calls stmt.log only if the record is actually formatted
+    '''
+    __slots__ = ('func', 'args')
+    
+    def __init__(self, func: Callable[..., Any], *args: Any) -> None:
+        self.func = func
+        self.args = args
+        
+    def __str__(self) -> str:
+        return str(self.func(*self.args))
+
+
+log_records_dropped = Counter(
+    'users_log_records_dropped_total',
+    'Log records dropped because the logging queue was full'
+)
 
 file_handler = logging.FileHandler(os.path.join(root_path, f'{SERVICE_NAME}.log'))
 file_handler.setLevel(logging.DEBUG)
@@ -26,8 +163,15 @@ file_handler.setFormatter(logging.Formatter(
     datefmt='%Y-%m-%d %H:%M:%S'
 ))
 
+log_queue: queue.Queue[logging.LogRecord] = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger(SERVICE_NAME)
-logger.addHandler(file_handler)
+logger.addHandler(DroppingQueueHandler(log_queue))
+if LOG_LEVEL:
+    logger.setLevel(LOG_LEVEL)
 
 SelfService = SelfAsyncService(
     self_service=Service(SERVICE_NAME),
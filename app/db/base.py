@@ -1,18 +1,122 @@
 import asyncio
+import itertools
+import time
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
-from config import DATABASE_URL
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+import config
+from cache import TTLCache
+from metrics import Gauge, Histogram
+from profiling import profile_phase
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+pool_checkout_wait = Histogram(
+    'users_db_pool_checkout_wait_seconds',
+    'Time spent waiting for a connection from the pool',
+    labelnames=('engine',)
+)
+pool_checked_out = Gauge(
+    'users_db_pool_checked_out',
+    'Connections currently checked out of the pool',
+    labelnames=('engine',)
+)
+replica_healthy = Gauge(
+    'users_db_replica_healthy',
+    '1 if the replica passed its last health check, 0 otherwise',
+    labelnames=('engine',)
+)
+pool_saturation = Gauge(
+    'users_db_pool_saturation',
+    'Checked out connections relative to pool_size + max_overflow',
+    labelnames=('engine',)
+)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    '''
+    AsyncAdaptedQueuePool that reports how long a checkout waited for a connection
+    '''
+    engine_name = 'primary'
+    
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_checkout_wait.labels(self.engine_name).observe(time.perf_counter() - start)
+
+
+class ProfiledAsyncSession(AsyncSession):
+    '''
+    AsyncSession reporting its round trips to the profile of the current request
+    '''
+    
+    async def execute(self, *args, **kwargs):
+        with profile_phase('db.execute'):
+            return await super().execute(*args, **kwargs)
+    
+    async def scalar(self, *args, **kwargs):
+        with profile_phase('db.execute'):
+            return await super().scalar(*args, **kwargs)
+    
+    async def commit(self) -> None:
+        with profile_phase('db.commit'):
+            await super().commit()
+
+
+def create_engine(url: str, name: str = 'primary') -> AsyncEngine:
+    pool_class = type(f'{name.capitalize()}InstrumentedPool', 
+                      (InstrumentedPool,), {'engine_name': name})
+    engine_ = create_async_engine(
+        url, 
+        echo=config.DATABASE_ECHO, 
+        future=True,
+        poolclass=pool_class,
+        pool_size=config.DATABASE_POOL_SIZE,
+        max_overflow=config.DATABASE_MAX_OVERFLOW,
+        pool_timeout=config.DATABASE_POOL_TIMEOUT,
+        pool_recycle=config.DATABASE_POOL_RECYCLE,
+        pool_pre_ping=config.DATABASE_POOL_PRE_PING,
+        connect_args={
+            'prepared_statement_cache_size': config.DATABASE_STATEMENT_CACHE_SIZE
+        }
+    )
+    capacity = config.DATABASE_POOL_SIZE + max(config.DATABASE_MAX_OVERFLOW, 0)
+    checked_out = pool_checked_out.labels(name)
+    saturation = pool_saturation.labels(name)
+    
+    def update_pool_metrics(*_) -> None:
+        checked_out.set(engine_.pool.checkedout())  # type: ignore[reportAttributeAccessIssue]
+        saturation.set(checked_out.value / capacity)
+    event.listen(engine_.sync_engine, 'checkout', update_pool_metrics)
+    event.listen(engine_.sync_engine, 'checkin', update_pool_metrics)
+    return engine_
+
+
+async def warm_up(engine_: AsyncEngine, connections: int) -> None:
+    '''
+    Opens the connections up front (holding all of them at once, 
+    so the pool can't hand out the same one twice), 
+    so the first requests don't pay the connect latency
+    '''
+    connections = min(connections, config.DATABASE_POOL_SIZE)
+    if connections <= 0:
+        return
+    conns = await asyncio.gather(*(engine_.connect().start() for _ in range(connections)))
+    await asyncio.gather(*(conn.execute(text('SELECT 1')) for conn in conns))
+    await asyncio.gather(*(conn.close() for conn in conns))
+
+
+engine = create_engine(config.DATABASE_URL)
 Base = declarative_base()
 
 async_session = sessionmaker(  # type: ignore[reportCallIssue]
     bind=engine,   # type: ignore[reportArgumentType]
-    class_=AsyncSession,
+    class_=ProfiledAsyncSession,
     expire_on_commit=False
 )
 
@@ -20,6 +124,89 @@ async_session = sessionmaker(  # type: ignore[reportCallIssue]
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with async_session() as session:  # type: ignore[reportGeneralTypeIssues]
         yield session
+
+
+class Replica:
+    
+    def __init__(self, name: str, url: str) -> None:
+        self.name = name
+        self.engine = create_engine(url, name=name)
+        self.session = sessionmaker(  # type: ignore[reportCallIssue]
+            bind=self.engine,  # type: ignore[reportArgumentType]
+            class_=ProfiledAsyncSession,
+            expire_on_commit=False,
+            info={'replica': name}
+        )
+        self.is_healthy = True
+        replica_healthy.labels(name).set(1)
+        
+    async def health_check(self) -> None:
+        try:
+            async with asyncio.timeout(config.DATABASE_REPLICA_HEALTH_TIMEOUT):
+                async with self.engine.connect() as conn:
+                    await conn.execute(text('SELECT 1'))
+            self.is_healthy = True
+        except Exception:
+            self.is_healthy = False
+        replica_healthy.labels(self.name).set(int(self.is_healthy))
+
+
+replicas = [Replica(f'replica_{i}', url) 
+            for i, url in enumerate(config.DATABASE_REPLICA_URLS)]
+_replicas_cycle = itertools.cycle(replicas)
+primary_pins: TTLCache[str, bool] = TTLCache(
+    'users_db_primary_pins', 
+    maxsize=100_000, 
+    ttl=config.DATABASE_REPLICA_PIN_SECONDS
+)
+
+
+def pin_to_primary(*keys: str) -> None:
+    '''
+    Sends reads about the keys (e.g. user ids) to the primary for 
+    DATABASE_REPLICA_PIN_SECONDS, so they see the write that was just made
+    '''
+    if replicas:
+        for key in keys:
+            primary_pins.set(key, True)
+            
+
+def is_pinned_to_primary(key: str) -> bool:
+    return bool(replicas) and primary_pins.get(key) is not None
+
+
+def is_replica_session(session: AsyncSession) -> bool:
+    return 'replica' in session.info
+
+
+def _next_replica() -> Replica | None:
+    for _ in range(len(replicas)):
+        replica = next(_replicas_cycle)
+        if replica.is_healthy:
+            return replica
+    return None
+
+
+@asynccontextmanager
+async def get_read_session(*keys: str) -> AsyncGenerator[AsyncSession, None]:
+    '''
+    A session for read-only work: a healthy replica picked round-robin, 
+    or the primary when there are no (healthy) replicas or any of the keys 
+    is pinned to the primary after a recent write
+    '''
+    replica = None
+    if not any(is_pinned_to_primary(key) for key in keys):
+        replica = _next_replica()
+    session_factory = replica.session if replica else async_session
+    async with session_factory() as session:  # type: ignore[reportGeneralTypeIssues]
+        yield session
+
+
+async def replicas_health_task() -> None:
+    while True:
+        await asyncio.gather(*(replica.health_check() for replica in replicas))
+        await asyncio.sleep(config.DATABASE_REPLICA_HEALTH_INTERVAL)
+        
         
 def _db_init():
     async def create_tables():
@@ -29,4 +216,4 @@ def _db_init():
     if loop.is_running():
         return loop.create_task(create_tables())
     else:
-        loop.run_until_complete(create_tables())
\ No newline at end of file
+        loop.run_until_complete(create_tables())
@@ -1,33 +1,121 @@
-from datetime import datetime
-from typing import Literal, Optional
+import asyncio
+from datetime import datetime, timedelta
+from itertools import batched
+from typing import (Any, AsyncIterator, Awaitable, Callable, Iterable, Literal,
+                    Optional, TypeVar)
 
-from db.models import Ban, Library, User
+import config
+from cache import TaggedTTLCache, TTLCache
+from db.base import (Base, get_read_session, get_session,
+                     is_pinned_to_primary, is_replica_session, pin_to_primary)
+from db.models import PERMANENT_BAN, Ban, BanArchive, Library, User, ulid
+from metrics import Counter, Histogram, timed
 from patisson_request.errors import ErrorCode, ErrorSchema, ValidateError
-from sqlalchemy import and_, case, exists, func, or_, select
+from singleflight import SingleFlight
+from sqlalchemy import and_, delete, func, insert, null, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
-
-
-def users_ban_subquery():
-    active_ban_subquery = (
-        select(func.count(Ban.id))
-        .where(
-            and_(
-                Ban.user_id == User.id,
-                or_(
-                    Ban.end_date == None, 
-                    Ban.end_date > func.now()
-                )
-            )
-        )
+
+db_query_latency = Histogram(
+    'users_db_query_seconds',
+    'Latency of the CRUD functions, including their database round trips',
+    labelnames=('function',)
+)
+
+LIBRARY_UNIQUE_CONSTRAINT = 'uq_libraries_user_id_book_id'
+EXPORT_FIELDS = {
+    User: ('id', 'username', 'first_name', 'last_name', 'avatar', 'about', 'role'),
+    Library: ('id', 'user_id', 'book_id', 'status'),
+}
+
+ModelT = TypeVar('ModelT', bound=Base)  # type: ignore[reportGeneralTypeIssues]
+BulkResult = list[tuple[Literal[True], ModelT] | tuple[Literal[False], ErrorSchema]]
+
+UserStatus = tuple[bool, Optional[datetime]]  # (exists, banned_until)
+user_status_cache: TTLCache[str, UserStatus] = TTLCache(
+    'users_user_status',
+    maxsize=config.USER_STATUS_CACHE_SIZE,
+    ttl=config.USER_STATUS_CACHE_TTL
+)
+
+# concurrent status lookups of the same user (e.g. bursts of /verify-user) share one query
+user_status_lookups: SingleFlight[str, UserStatus] = SingleFlight('users_user_status')
+
+# results of the read queries over users and libraries (GraphQL), tagged with
+# 'users' / 'libraries' for filtered queries or users:<id> / libraries:<user id>
+query_results_cache: TaggedTTLCache[tuple, Any] = TaggedTTLCache(
+    'users_query_results',
+    maxsize=config.QUERY_RESULTS_CACHE_SIZE,
+    ttl=config.QUERY_RESULTS_CACHE_TTL
+)
+
+def _ban_state_changed(user_ids: Iterable[str]) -> None:
+    '''
+    Drops the cached ban state of the users after their bans have changed 
+    and sends their reads to the primary for a while
+    '''
+    user_ids = set(user_ids)
+    for user_id in user_ids:
+        pin_to_primary(user_id)
+        user_status_cache.invalidate(user_id)
+        user_status_lookups.forget(user_id)
+    if user_ids:
+        query_results_cache.invalidate_tags('users', *(f'users:{user_id}' for user_id in user_ids))
+
+
+def banned_clause():
+    '''
+    The user has an active ban, a plain predicate on users.banned_until
+    served by its partial index
+    '''
+    return and_(User.banned_until != None, User.banned_until > func.now())
+
+
+def users_is_banned_column():
+    return banned_clause().label("is_banned")
+
+
+def users_status_stmt(user_ids: list[str]):
+    '''
+    A single round trip returning (id, banned_until) for the users, 
+    a missing row means that there is no such user
+    '''
+    return select(User.id, User.banned_until).where(User.id.in_(user_ids))
+
+
+def _extend_ban_stmt(user_id: str, end_date: Optional[datetime]):
+    # GREATEST ignores NULL, so a first ban sets the column and a shorter one keeps it
+    return (
+        update(User)
+        .where(User.id == user_id)
+        .values(banned_until=func.greatest(User.banned_until, end_date or PERMANENT_BAN))
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def _extend_bans(session: AsyncSession, ban_ids: set[str]) -> None:
+    '''
+    The bulk version of _extend_ban_stmt for the just inserted bans
+    '''
+    if not ban_ids:
+        return
+    bans = (
+        select(Ban.user_id, func.max(func.coalesce(Ban.end_date, PERMANENT_BAN)).label('until'))
+        .where(Ban.id.in_(ban_ids))
+        .group_by(Ban.user_id)
+        .subquery()
+    )
+    await session.execute(
+        update(User)
+        .where(User.id == bans.c.user_id)
+        .values(banned_until=func.greatest(User.banned_until, bans.c.until))
+        .execution_options(synchronize_session=False)
     )
-    return case(       
-        (active_ban_subquery.scalar_subquery() > 0, True),
-        else_=False).label("is_banned")
     
 
+@timed(db_query_latency, 'create_user')
 async def create_user(session: AsyncSession, role: str,
                       username: str, password: str, 
                       first_name: Optional[str] = None,
@@ -49,9 +137,11 @@ async def create_user(session: AsyncSession, role: str,
             last_name=last_name, avatar=avatar,
             about=about, role=role
         )
-        user.set_password(password)
+        await user.set_password_async(password)
         session.add(user)
         await session.commit()
+        pin_to_primary(user.id)  # type: ignore[reportArgumentType]
+        query_results_cache.invalidate_tags('users')
         return True, user
     
     except SQLAlchemyError as e:
@@ -68,6 +158,7 @@ async def create_user(session: AsyncSession, role: str,
         )
         
 
+@timed(db_query_latency, 'create_library')
 async def create_library(session: AsyncSession, book_id: str,
                          user_id: str, status: Library.Status) -> (
                           tuple[Literal[True], Library]
@@ -78,22 +169,18 @@ async def create_library(session: AsyncSession, book_id: str,
             book_id=book_id, user_id=user_id,
             status=status
         )
-        
-        record_exists = await session.scalar(
-            select(exists().where(Library.user_id == user_id, Library.book_id == book_id))
-        )
-        if record_exists:
-            return False, ErrorSchema(
-                error=ErrorCode.ACCESS_ERROR,
-                extra=f"The user ({user_id}) already has this book ({book_id}) in their library"
-            )
-            
         session.add(library)
         await session.commit()
+        query_results_cache.invalidate_tags('libraries', f'libraries:{user_id}')
         return True, library
     
-    except IntegrityError:
+    except IntegrityError as e:
         await session.rollback()
+        if LIBRARY_UNIQUE_CONSTRAINT in str(e.orig):
+            return False, ErrorSchema(
+                error=ErrorCode.ACCESS_ERROR,
+                extra=f"The user ({user_id}) already has this book ({book_id}) in their library"
+            )
         return False, ErrorSchema(
             error=ErrorCode.INVALID_PARAMETERS,
             extra=f'The user ({user_id}) was not found'
@@ -114,6 +201,7 @@ async def create_library(session: AsyncSession, book_id: str,
         )
 
 
+@timed(db_query_latency, 'create_ban')
 async def create_ban(session: AsyncSession, user_id: str,
                      reason: Ban.Reason, comment: str, end_date: datetime) -> ( 
                         tuple[Literal[True], Ban]
@@ -125,7 +213,9 @@ async def create_ban(session: AsyncSession, user_id: str,
             comment=comment, end_date=end_date
         )
         session.add(ban)
+        await session.execute(_extend_ban_stmt(user_id, end_date))
         await session.commit()
+        _ban_state_changed([user_id])
         return True, ban
     
     except IntegrityError:
@@ -149,29 +239,518 @@ async def create_ban(session: AsyncSession, user_id: str,
         )
         
         
+def _validated(model: type[ModelT], **fields) -> ModelT | ErrorSchema:
+    '''
+    Builds the object of one item of a bulk request, or the error of the item. 
+    Omitted optional fields (None) are left to the column defaults, 
+    the model validators only accept actual values
+    '''
+    fields = {key: value for key, value in fields.items() if value is not None}
+    try:
+        return model(id=ulid(), **fields)
+    except (ValidateError, TypeError, ValueError) as e:
+        return ErrorSchema(
+            error=ErrorCode.VALIDATE_ERROR,
+            extra=str(e)
+        )
+
+
+async def _bulk_insert(session: AsyncSession, objects: list[ModelT],
+                       conflict_columns: Optional[list[Any]] = None,
+                       after_insert: Optional[Callable[[AsyncSession, set[str]], Awaitable[None]]] = None
+                       ) -> set[str]:
+    '''
+    Inserts the objects with multi-row INSERT ... RETURNING id statements 
+    (chunked by BULK_INSERT_CHUNK_SIZE) in one transaction and returns 
+    the ids of the inserted rows. Rows conflicting on conflict_columns 
+    are skipped instead of failing the whole statement. after_insert 
+    runs in the same transaction with the inserted ids
+    '''
+    if not objects:
+        return set()
+    table = objects[0].__table__  # type: ignore[reportAttributeAccessIssue]
+    rows = [{column.key: getattr(obj, column.key) for column in table.columns} 
+            for obj in objects]
+    inserted = set()
+    for chunk in batched(rows, config.BULK_INSERT_CHUNK_SIZE):
+        stmt = pg_insert(table).values(list(chunk))
+        if conflict_columns is not None:
+            stmt = stmt.on_conflict_do_nothing(index_elements=conflict_columns)
+        result = await session.execute(stmt.returning(table.c.id))
+        inserted.update(result.scalars().all())
+    if after_insert is not None:
+        await after_insert(session, inserted)
+    await session.commit()
+    return inserted
+
+
+async def _existing_user_ids(session: AsyncSession, user_ids: Iterable[str]) -> set[str]:
+    result = await session.execute(
+        select(User.id).where(User.id.in_(set(user_ids)))
+    )
+    return set(result.scalars().all())
+
+
+async def _bulk_create(session: AsyncSession, 
+                       objects: list[ModelT | ErrorSchema],
+                       conflict_columns: Optional[list[Any]],
+                       conflict_error: Any,
+                       after_insert: Optional[Callable[[AsyncSession, set[str]], Awaitable[None]]] = None
+                       ) -> BulkResult[ModelT]:
+    valid = [obj for obj in objects if not isinstance(obj, ErrorSchema)]
+    try:
+        inserted = await _bulk_insert(session, valid, conflict_columns, after_insert)
+    except SQLAlchemyError as e:
+        await session.rollback()
+        error = ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra=str(e)
+        )
+        return [(False, obj if isinstance(obj, ErrorSchema) else error) 
+                for obj in objects]
+    
+    results: BulkResult[ModelT] = []
+    for obj in objects:
+        if isinstance(obj, ErrorSchema):
+            results.append((False, obj))
+        elif obj.id in inserted:  # type: ignore[reportAttributeAccessIssue]
+            results.append((True, obj))
+        else:
+            results.append((False, conflict_error(obj)))
+    return results
+
+
+@timed(db_query_latency, 'create_users')
+async def create_users(session: AsyncSession, role: str, 
+                       users: list[dict[str, Any]]) -> BulkResult[User]:
+    '''
+    The bulk version of create_user. Every item takes the keyword arguments 
+    of create_user (except session and role), the results are in the order 
+    of the items. Passwords are hashed in parallel, users whose username 
+    is already taken (including earlier in the same batch) are skipped
+    '''
+    objects: list[User | ErrorSchema] = []
+    for item in users:
+        fields = {key: value for key, value in item.items() if key != 'password'}
+        objects.append(_validated(User, role=role, **fields))
+    
+    async def set_password(user: User | ErrorSchema, password: str) -> User | ErrorSchema:
+        if isinstance(user, ErrorSchema):
+            return user
+        try:
+            await user.set_password_async(password)
+            return user
+        except ValidateError as e:
+            return ErrorSchema(
+                error=ErrorCode.VALIDATE_ERROR,
+                extra=str(e)
+            )
+    objects = list(await asyncio.gather(
+        *(set_password(user, item['password']) for user, item in zip(objects, users))
+    ))
+    
+    results = await _bulk_create(
+        session, objects, [User.username],
+        lambda user: ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra=f'the username ({user.username}) is already taken'
+        )
+    )
+    created = [user.id for is_valid, user in results if is_valid]
+    if created:
+        pin_to_primary(*created)  # type: ignore[reportArgumentType]
+        query_results_cache.invalidate_tags('users')
+    return results
+
+
+@timed(db_query_latency, 'create_libraries')
+async def create_libraries(session: AsyncSession, 
+                           libraries: list[dict[str, Any]]) -> BulkResult[Library]:
+    '''
+    The bulk version of create_library. Every item takes the keyword 
+    arguments of create_library (except session), the results are 
+    in the order of the items
+    '''
+    objects: list[Library | ErrorSchema] = [_validated(Library, **item) for item in libraries]
+    existing_users = await _existing_user_ids(
+        session, (obj.user_id for obj in objects if not isinstance(obj, ErrorSchema)))  # type: ignore[reportArgumentType]
+    objects = [
+        ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra=f'The user ({obj.user_id}) was not found'
+        ) if not isinstance(obj, ErrorSchema) and obj.user_id not in existing_users else obj
+        for obj in objects
+    ]
+    results = await _bulk_create(
+        session, objects, [Library.user_id, Library.book_id],
+        lambda library: ErrorSchema(
+            error=ErrorCode.ACCESS_ERROR,
+            extra=f"The user ({library.user_id}) already has this book ({library.book_id}) in their library"
+        )
+    )
+    user_ids = {body.user_id for is_valid, body in results if is_valid}  # type: ignore[reportAttributeAccessIssue]
+    if user_ids:
+        query_results_cache.invalidate_tags(
+            'libraries', *(f'libraries:{user_id}' for user_id in user_ids))
+    return results
+
+
+@timed(db_query_latency, 'create_bans')
+async def create_bans(session: AsyncSession, 
+                      bans: list[dict[str, Any]]) -> BulkResult[Ban]:
+    '''
+    The bulk version of create_ban. Every item takes the keyword 
+    arguments of create_ban (except session), the results are 
+    in the order of the items
+    '''
+    objects: list[Ban | ErrorSchema] = [_validated(Ban, **item) for item in bans]
+    existing_users = await _existing_user_ids(
+        session, (obj.user_id for obj in objects if not isinstance(obj, ErrorSchema)))  # type: ignore[reportArgumentType]
+    objects = [
+        ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra=f'The user ({obj.user_id}) was not found'
+        ) if not isinstance(obj, ErrorSchema) and obj.user_id not in existing_users else obj
+        for obj in objects
+    ]
+    results = await _bulk_create(
+        session, objects, None,
+        lambda ban: ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra=f'The ban for the user ({ban.user_id}) was not created'
+        ),
+        after_insert=_extend_bans
+    )
+    _ban_state_changed(body.user_id for is_valid, body in results if is_valid)  # type: ignore[reportAttributeAccessIssue]
+    return results
+
+
+def _archive_bans_stmt(bans_ids, revoked: bool = False):
+    '''
+    Moves the bans to bans_archive in a single statement
+    (WITH moved AS (DELETE ... RETURNING) INSERT ... SELECT)
+    '''
+    moved = (
+        delete(Ban)
+        .where(Ban.id.in_(bans_ids))
+        .returning(Ban.id, Ban.user_id, Ban.reason, Ban.comment, Ban.end_date)
+        .cte('moved')
+    )
+    return insert(BanArchive).from_select(
+        ['id', 'user_id', 'reason', 'comment', 'end_date', 'revoked_at'],
+        select(moved.c.id, moved.c.user_id, moved.c.reason, moved.c.comment, moved.c.end_date,
+               func.now() if revoked else null())
+    )
+
+
+def _active_until_subquery(user_id: str):
+    return (
+        select(func.max(func.coalesce(Ban.end_date, PERMANENT_BAN)))
+        .where(Ban.user_id == user_id, 
+               (Ban.end_date == None) | (Ban.end_date > func.now()))
+        .scalar_subquery()
+    )
+
+
+@timed(db_query_latency, 'revoke_ban')
+async def revoke_ban(session: AsyncSession, ban_id: str) -> (
+                        tuple[Literal[True], str]
+                        | tuple[Literal[False], ErrorSchema]
+                    ):
+    '''
+    Ends the ban now: it is moved to bans_archive and the user's 
+    banned_until is recomputed from the remaining bans in the same 
+    transaction. Returns the id of the user
+    '''
+    not_found = ErrorSchema(
+        error=ErrorCode.INVALID_PARAMETERS,
+        extra=f'The ban ({ban_id}) was not found'
+    )
+    try:
+        user_id = await session.scalar(select(Ban.user_id).where(Ban.id == ban_id))
+        if user_id is None:
+            return False, not_found
+        # serializes with create_ban, which raises banned_until under the same row lock
+        await session.execute(select(User.id).where(User.id == user_id).with_for_update())
+        result = await session.execute(_archive_bans_stmt([ban_id], revoked=True))
+        if result.rowcount == 0:  # revoked concurrently
+            await session.rollback()
+            return False, not_found
+        await session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(banned_until=_active_until_subquery(user_id))
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+    
+    except SQLAlchemyError as e:
+        await session.rollback()
+        return False, ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra=str(e)
+        )
+    _ban_state_changed([user_id])
+    return True, user_id
+
+
+bans_expired = Counter(
+    'users_bans_expired_total',
+    'Users whose last active ban ended, cleared by the ban sweeper'
+)
+bans_archived = Counter(
+    'users_bans_archived_total',
+    'Ended bans moved to bans_archive by the ban sweeper'
+)
+
+
+async def _clear_expired_bans(session: AsyncSession) -> list[str]:
+    due = (
+        select(User.id)
+        .where(User.banned_until != None, User.banned_until <= func.now())
+        .order_by(User.banned_until)  # the partial index on banned_until
+        .limit(config.BAN_SWEEP_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(User)
+        # rechecked after the row lock, a concurrent create_ban may have extended it
+        .where(User.id.in_(due), User.banned_until <= func.now())
+        .values(banned_until=None)
+        .returning(User.id)
+        .execution_options(synchronize_session=False)
+    )
+    user_ids = list(result.scalars().all())
+    await session.commit()
+    return user_ids
+
+
+async def _archive_ended_bans(session: AsyncSession) -> int:
+    cutoff = datetime.now() - timedelta(days=config.BAN_ARCHIVE_AFTER_DAYS)
+    ended = (
+        select(Ban.id)
+        .where(Ban.end_date < cutoff)
+        .order_by(Ban.end_date)  # ix_bans_end_date
+        .limit(config.BAN_SWEEP_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await session.execute(_archive_bans_stmt(ended))
+    await session.commit()
+    return result.rowcount
+
+
+async def sweep_bans() -> float:
+    '''
+    Clears banned_until of the users whose bans have ended and archives 
+    the bans that ended BAN_ARCHIVE_AFTER_DAYS ago, both in batches. 
+    Returns the number of seconds until the next ban ends (at most 
+    BAN_SWEEP_INTERVAL). Several workers may sweep at once, locked rows 
+    are skipped
+    '''
+    async with get_session() as session:
+        while True:
+            user_ids = await _clear_expired_bans(session)
+            if user_ids:
+                bans_expired.inc(len(user_ids))
+                _ban_state_changed(user_ids)
+            if len(user_ids) < config.BAN_SWEEP_BATCH_SIZE:
+                break
+        
+        if config.BAN_ARCHIVE_AFTER_DAYS > 0:
+            while True:
+                archived = await _archive_ended_bans(session)
+                bans_archived.inc(archived)
+                if archived < config.BAN_SWEEP_BATCH_SIZE:
+                    break
+        
+        next_end = await session.scalar(
+            select(func.min(User.banned_until)).where(User.banned_until > func.now()))
+    if next_end is None:
+        return config.BAN_SWEEP_INTERVAL
+    return min(max((next_end - datetime.now()).total_seconds(), 0.1), config.BAN_SWEEP_INTERVAL)
+
+
+async def ban_expiry_task() -> None:
+    while True:
+        try:
+            delay = await sweep_bans()
+        except Exception as e:
+            config.logger.warning('the ban sweep failed: %r', e)
+            delay = config.BAN_SWEEP_INTERVAL
+        await asyncio.sleep(delay)
+        
+        
+def _user_status_error(status: UserStatus) -> Optional[ErrorSchema]:
+    exists, banned_until = status
+    if not exists:
+        return ErrorSchema(
+            error=ErrorCode.INVALID_PARAMETERS,
+            extra='There is no user with the specified id'
+        )
+    if banned_until is not None and banned_until > datetime.now():
+        return ErrorSchema(
+            error=ErrorCode.VALIDATE_ERROR,
+            extra='the user is banned'
+        )
+    return None
+
+
+@timed(db_query_latency, 'get_active_user')
 async def get_active_user(session: AsyncSession, user_id: str) -> (
                         tuple[Literal[True], User]
                         | tuple[Literal[False], ErrorSchema]
                     ):    
     result = await session.execute(
         select(User)
-        .options(joinedload(User.ban))
         .where(User.id == user_id)
     )
     user = result.scalars().first()
 
-    if not user:
-        return False, ErrorSchema(
-            error=ErrorCode.INVALID_PARAMETERS,
-            extra='There is no user with the specified id'
-        )
+    error = _user_status_error(
+        _row_status(user.banned_until) if user else (False, None)  # type: ignore[reportArgumentType]
+    )
+    if error:
+        return False, error
+    return True, user  # type: ignore[reportReturnType]
 
-    for ban in user.ban:
-        if ban.end_date is None or ban.end_date > datetime.now():
-            return False, ErrorSchema(
-                error=ErrorCode.VALIDATE_ERROR,
-                extra='the user is banned'
-            )
-            
-    return True, user
-    
\ No newline at end of file
+
+def _row_status(banned_until: Optional[datetime]) -> UserStatus:
+    if banned_until is None or banned_until <= datetime.now():
+        return True, None
+    return True, banned_until
+
+
+def _cache_user_status(user_id: str, status: UserStatus) -> None:
+    if is_pinned_to_primary(user_id):
+        return  # the status may have been read from a lagging replica
+    ttl = None
+    if status[1] is not None and status[1] != PERMANENT_BAN:
+        ttl = (status[1] - datetime.now()).total_seconds()
+    user_status_cache.set(user_id, status, ttl=ttl)
+
+
+async def _fetch_users_status(session: AsyncSession, 
+                              user_ids: list[str]) -> dict[str, UserStatus]:
+    '''
+    Reads the status of the users, the ones a replica doesn't know are 
+    looked up again on the primary, since the replica may not have 
+    caught up with their creation yet (pins are per process)
+    '''
+    result = await session.execute(users_status_stmt(user_ids))
+    fetched = {row.id: _row_status(row.banned_until) for row in result}
+    missing = [user_id for user_id in user_ids if user_id not in fetched]
+    if missing and is_replica_session(session):
+        async with get_session() as primary_session:
+            result = await primary_session.execute(users_status_stmt(missing))
+            fetched.update({row.id: _row_status(row.banned_until) for row in result})
+    return fetched
+
+
+@timed(db_query_latency, 'get_user_status')
+async def get_user_status(session: AsyncSession, user_id: str) -> UserStatus:
+    return (await _fetch_users_status(session, [user_id])).get(user_id, (False, None))
+
+
+@timed(db_query_latency, 'get_users_status')
+async def get_users_status(session: AsyncSession, 
+                           user_ids: list[str]) -> dict[str, UserStatus]:
+    '''
+    Resolves the status of all passed users: cached ones are taken 
+    from user_status_cache, the rest is fetched with one IN query
+    '''
+    statuses: dict[str, UserStatus] = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        status = user_status_cache.get(user_id)
+        if status is None:
+            missing.append(user_id)
+        else:
+            statuses[user_id] = status
+    
+    if missing:
+        fetched = await _fetch_users_status(session, missing)
+        for user_id in missing:
+            statuses[user_id] = fetched.get(user_id, (False, None))
+            _cache_user_status(user_id, statuses[user_id])
+    return statuses
+
+
+async def check_active_user(session: AsyncSession, user_id: str) -> (
+                        tuple[Literal[True], None]
+                        | tuple[Literal[False], ErrorSchema]
+                    ):
+    '''
+    Same check as get_active_user, but without loading the User. 
+    The (exists, banned_until) status is kept in user_status_cache, 
+    a cached ban stops applying by itself once its end date has passed.
+    Concurrent misses for the same user share one query (user_status_lookups)
+    '''
+    async def fetch() -> UserStatus:
+        status = await get_user_status(session, user_id)
+        _cache_user_status(user_id, status)
+        return status
+    
+    status = user_status_cache.get(user_id)
+    if status is None:
+        status = await user_status_lookups.do(user_id, fetch)
+    
+    error = _user_status_error(status)
+    if error:
+        return False, error
+    return True, None
+
+
+async def check_active_users(session: AsyncSession, user_ids: list[str]) -> list[
+                        tuple[Literal[True], None]
+                        | tuple[Literal[False], ErrorSchema]
+                    ]:
+    '''
+    check_active_user for several users at once, 
+    the results are in the order of user_ids
+    '''
+    statuses = await get_users_status(session, user_ids)
+    results = []
+    for user_id in user_ids:
+        error = _user_status_error(statuses[user_id])
+        results.append((False, error) if error else (True, None))
+    return results  # type: ignore[reportReturnType]
+
+
+async def stream_export(model: type[User] | type[Library], fields: list[str],
+                        filters: dict[str, Optional[list[str]]],
+                        is_banned: Optional[bool] = None
+                        ) -> AsyncIterator[list[dict[str, Any]]]:
+    '''
+    Streams the rows of the model matching the filters (column name -> values, 
+    None to skip the filter) as batches of {field: value}, ordered by id.
+    
+    The rows are read from a read session with a server-side cursor, 
+    in keyset chunks of EXPORT_CHUNK_SIZE rows: every chunk runs in its own 
+    short transaction, so a slow consumer never holds a long one
+    '''
+    columns = [getattr(model, field) for field in fields]
+    if 'id' not in fields:
+        columns.append(model.id)  # the keyset cursor
+    stmt = select(*columns).order_by(model.id)
+    for column, values in filters.items():
+        if values is not None:
+            stmt = stmt.where(getattr(model, column).in_(values))
+    if is_banned is not None:  # users only
+        stmt = stmt.where(banned_clause() if is_banned else ~banned_clause())
+    
+    after = None
+    while True:
+        chunk_stmt = stmt if after is None else stmt.where(model.id > after)
+        chunk_stmt = chunk_stmt.limit(config.EXPORT_CHUNK_SIZE).execution_options(
+            yield_per=config.EXPORT_FETCH_SIZE)
+        count = 0
+        async with get_read_session() as session:
+            result = await session.stream(chunk_stmt)
+            async for rows in result.partitions():
+                count += len(rows)
+                after = rows[-1].id
+                yield [{field: getattr(row, field) for field in fields} for row in rows]
+        if count < config.EXPORT_CHUNK_SIZE:
+            return
@@ -0,0 +1,292 @@
+"""
+This module brings existing databases up to date with the schema declared in
+db.models. New databases get everything from Base.metadata.create_all, so
+every migration is written to be idempotent and is a no-op on them.
+
+Applied migrations are recorded in the schema_migrations table. Indexes are
+built with CREATE INDEX CONCURRENTLY, so each statement runs in autocommit
+mode and does not lock the tables against writes, and an invalid index left by
+a failed build is dropped and rebuilt when the migration is rerun.
+
+A migration step is either an SQL statement or an async function taking
+the (autocommit) connection, for data migrations done in batches.
+
+Run from the app directory:
+    python -m db.migrations
+    python -m db.migrations backfill-banned-until
+    python -m db.migrations ids-to-uuid     # see db.types, then set DATABASE_UUID_IDS
+    python -m db.migrations ids-to-varchar  # unset DATABASE_UUID_IDS first
+"""
+
+import asyncio
+import sys
+from typing import Awaitable, Callable, Optional
+
+import config
+from db.base import engine
+from db.models import PERMANENT_BAN
+from db.types import ULIDKey
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+BACKFILL_BATCH_SIZE = 10_000
+MIN_ULID = '0' * 26  # below every generated key
+
+Step = str | Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def _index_is_valid(conn: AsyncConnection, name: str) -> Optional[bool]:
+    return (await conn.execute(text(
+        'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+        'WHERE c.relname = :name AND pg_table_is_visible(c.oid)'
+    ), {'name': name})).scalar()
+
+
+def concurrent_index(name: str, statement: str) -> Step:
+    '''
+    A CREATE INDEX CONCURRENTLY IF NOT EXISTS step. A failed or interrupted 
+    concurrent build leaves an invalid index that IF NOT EXISTS would skip, 
+    so an invalid one is dropped first, and the step fails unless 
+    the index is valid in the end (the migration is not recorded)
+    '''
+    async def step(conn: AsyncConnection) -> None:
+        if await _index_is_valid(conn, name) is False:
+            await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+        await conn.execute(text(statement))
+        if not await _index_is_valid(conn, name):
+            raise RuntimeError(f'the index {name} was not built, rerun the migrations')
+    return step
+
+
+async def backfill_banned_until(conn: AsyncConnection) -> None:
+    '''
+    Sets users.banned_until from the active bans, in batches of users 
+    (one short transaction each). Safe to rerun and to run while the 
+    service writes bans, since both only ever raise the value
+    '''
+    after = MIN_ULID
+    updated = 0
+    while True:
+        last_id = (await conn.execute(text('''
+            SELECT id FROM (SELECT id FROM users WHERE id > :after ORDER BY id LIMIT :limit) s
+            ORDER BY id DESC LIMIT 1
+        ''').bindparams(bindparam('after', type_=ULIDKey())).columns(id=ULIDKey()),
+            {'after': after, 'limit': BACKFILL_BATCH_SIZE})).scalar()
+        if last_id is None:
+            break
+        result = await conn.execute(text('''
+            UPDATE users u SET banned_until = GREATEST(u.banned_until, b.until)
+            FROM (
+                SELECT user_id, max(COALESCE(end_date, :permanent)) AS until
+                FROM bans
+                WHERE user_id > :after AND user_id <= :last_id
+                    AND (end_date IS NULL OR end_date > now())
+                GROUP BY user_id
+            ) b
+            WHERE u.id = b.user_id
+        ''').bindparams(bindparam('after', type_=ULIDKey()), bindparam('last_id', type_=ULIDKey())),
+            {'after': after, 'last_id': last_id, 'permanent': PERMANENT_BAN})
+        updated += result.rowcount
+        after = last_id
+    config.logger.info('banned_until backfilled for %s users', updated)
+
+
+ULID_FUNCTIONS = [
+    '''
+    CREATE OR REPLACE FUNCTION ulid_to_uuid(ulid text) RETURNS uuid AS $$
+    DECLARE
+        alphabet CONSTANT text := '0123456789ABCDEFGHJKMNPQRSTVWXYZ';
+        bits bit varying := B'';
+        hex text := '';
+    BEGIN
+        FOR i IN 1..26 LOOP
+            bits := bits || (strpos(alphabet, upper(substr(ulid, i, 1))) - 1)::bit(5);
+        END LOOP;
+        bits := substring(bits FROM 3);  -- 130 bits, the first 2 are always 0
+        FOR i IN 0..31 LOOP
+            hex := hex || to_hex(substring(bits FROM i * 4 + 1 FOR 4)::bit(4)::int);
+        END LOOP;
+        RETURN hex::uuid;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE STRICT
+    ''',
+    '''
+    CREATE OR REPLACE FUNCTION uuid_to_ulid(id uuid) RETURNS text AS $$
+    DECLARE
+        alphabet CONSTANT text := '0123456789ABCDEFGHJKMNPQRSTVWXYZ';
+        bits bit varying := B'00' || ('x' || replace(id::text, '-', ''))::bit(128);
+        ulid text := '';
+    BEGIN
+        FOR i IN 0..25 LOOP
+            ulid := ulid || substr(alphabet, substring(bits FROM i * 5 + 1 FOR 5)::bit(5)::int + 1, 1);
+        END LOOP;
+        RETURN ulid;
+    END
+    $$ LANGUAGE plpgsql IMMUTABLE STRICT
+    ''',
+]
+
+# (table, key columns), missing tables (e.g. bans_archive before 0003) are skipped;
+# the foreign keys to users.id are dropped and restored around the change
+ID_COLUMNS = [
+    ('users', ['id']),
+    ('libraries', ['id', 'user_id']),
+    ('bans', ['id', 'user_id']),
+    ('bans_archive', ['id', 'user_id']),
+]
+USER_FOREIGN_KEYS = [('libraries', 'libraries_user_id_fkey'), ('bans', 'bans_user_id_fkey')]
+
+
+async def _users_id_type(conn: AsyncConnection) -> str:
+    return (await conn.execute(text(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'users' AND column_name = 'id'"
+    ))).scalar()  # type: ignore[reportReturnType]
+
+
+async def create_bans_archive(conn: AsyncConnection) -> None:
+    '''
+    Creates bans_archive with the current type of the keys, 
+    the ids may have been converted (ids-to-uuid) before this migration
+    '''
+    key_type = 'UUID' if await _users_id_type(conn) == 'uuid' else 'VARCHAR'
+    await conn.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS bans_archive (
+            id {key_type} PRIMARY KEY,
+            user_id {key_type} NOT NULL,
+            reason reason NOT NULL,
+            comment TEXT,
+            end_date TIMESTAMP WITHOUT TIME ZONE,
+            revoked_at TIMESTAMP WITHOUT TIME ZONE,
+            archived_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+    '''))
+
+
+async def convert_ids(to_uuid: bool) -> bool:
+    '''
+    Changes the type of the key columns to uuid (or back to varchar) and
+    returns whether anything was changed. Every table is rewritten and its
+    indexes rebuilt under an exclusive lock in a single transaction, so
+    the service should be stopped while it runs. Run it before (to uuid)
+    or after (to varchar) switching DATABASE_UUID_IDS
+    '''
+    async with engine.begin() as conn:
+        current = await _users_id_type(conn)
+        if (current == 'uuid') == to_uuid:
+            return False
+        for statement in ULID_FUNCTIONS:
+            await conn.execute(text(statement))
+        tables = [(table, columns) for table, columns in ID_COLUMNS if (await conn.execute(
+            text('SELECT to_regclass(:table) IS NOT NULL'), {'table': table})).scalar()]
+        for table, constraint in USER_FOREIGN_KEYS:
+            await conn.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}'))
+        for table, columns in tables:
+            if to_uuid:
+                changes = [f'ALTER COLUMN {column} TYPE uuid USING ulid_to_uuid({column})'
+                           for column in columns]
+            else:
+                changes = [f'ALTER COLUMN {column} TYPE varchar USING uuid_to_ulid({column})'
+                           for column in columns]
+            await conn.execute(text(f'ALTER TABLE {table} ' + ', '.join(changes)))
+        for table, constraint in USER_FOREIGN_KEYS:
+            await conn.execute(text(
+                f'ALTER TABLE {table} ADD CONSTRAINT {constraint} '
+                'FOREIGN KEY (user_id) REFERENCES users (id)'))
+        for table, _ in tables:
+            await conn.execute(text(f'ANALYZE {table}'))
+    return True
+
+MIGRATIONS: list[tuple[str, list[Step]]] = [
+    ('0001_library_and_ban_indexes', [
+        # keep the oldest row of every duplicated (user_id, book_id) pair,
+        # otherwise the unique index cannot be built
+        '''
+        DELETE FROM libraries l
+        USING libraries d
+        WHERE l.user_id = d.user_id AND l.book_id = d.book_id AND l.id > d.id
+        ''',
+        concurrent_index('uq_libraries_user_id_book_id', '''
+        CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_libraries_user_id_book_id
+        ON libraries (user_id, book_id)
+        '''),
+        '''
+        DO $$ BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conname = 'uq_libraries_user_id_book_id'
+            ) THEN
+                ALTER TABLE libraries ADD CONSTRAINT uq_libraries_user_id_book_id
+                UNIQUE USING INDEX uq_libraries_user_id_book_id;
+            END IF;
+        END $$
+        ''',
+        concurrent_index('ix_libraries_book_id',
+                         'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_libraries_book_id ON libraries (book_id)'),
+        concurrent_index('ix_bans_user_id_end_date', 'CREATE INDEX CONCURRENTLY IF NOT EXISTS '
+                         'ix_bans_user_id_end_date ON bans (user_id, end_date)'),
+        concurrent_index('ix_bans_end_date',
+                         'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_bans_end_date ON bans (end_date)'),
+    ]),
+    ('0002_users_banned_until', [
+        # nullable without a default: a catalog-only change, no table rewrite
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS banned_until TIMESTAMP WITHOUT TIME ZONE',
+        concurrent_index('ix_users_banned_until', '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_banned_until
+        ON users (banned_until) WHERE banned_until IS NOT NULL
+        '''),
+        backfill_banned_until,
+    ]),
+    ('0003_bans_archive', [
+        create_bans_archive,
+        'CREATE INDEX IF NOT EXISTS ix_bans_archive_user_id ON bans_archive (user_id)',
+    ]),
+]
+
+
+async def migrate() -> list[str]:
+    '''
+    Applies the migrations that are not recorded in schema_migrations yet
+    and returns their names
+    '''
+    applied_now = []
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations '
+            '(name VARCHAR PRIMARY KEY, applied_at TIMESTAMP NOT NULL DEFAULT now())'
+        ))
+        applied = set((await conn.execute(
+            text('SELECT name FROM schema_migrations'))).scalars().all())
+        for name, statements in MIGRATIONS:
+            if name in applied:
+                continue
+            for step in statements:
+                if isinstance(step, str):
+                    await conn.execute(text(step))
+                else:
+                    await step(conn)
+            await conn.execute(
+                text('INSERT INTO schema_migrations (name) VALUES (:name)'), {'name': name})
+            applied_now.append(name)
+    return applied_now
+
+
+async def backfill() -> None:
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await backfill_banned_until(conn)
+
+
+if __name__ == "__main__":
+    async def main():
+        if sys.argv[1:] == ['backfill-banned-until']:
+            await backfill()
+            print('banned_until backfilled')
+        elif sys.argv[1:] in (['ids-to-uuid'], ['ids-to-varchar']):
+            changed = await convert_ids(to_uuid=sys.argv[1] == 'ids-to-uuid')
+            print('converted' if changed else 'already converted')
+        else:
+            applied = await migrate()
+            print('applied: ' + (', '.join(applied) if applied else 'nothing'))
+        await engine.dispose()
+    asyncio.run(main())
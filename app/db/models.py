@@ -3,22 +3,30 @@ import re
 from datetime import datetime
 
 from db.base import Base
-from passlib.context import CryptContext
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, String, Text
+from db.passwords import hash_password, pwd_context, verify_password
+from db.types import ULIDKey
+from sqlalchemy import (Column, DateTime, Enum, ForeignKey, Index, String, Text,
+                        UniqueConstraint, text)
 from sqlalchemy.orm import relationship, validates
 from ulid import ULID
 from patisson_request.errors import ValidateError
 
+PERMANENT_BAN = datetime.max  # users.banned_until of a user banned forever
+
+
 def ulid() -> str:
     return str(ULID())
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        # only the users who have ever been banned are indexed
+        Index('ix_users_banned_until', 'banned_until', 
+              postgresql_where=text('banned_until IS NOT NULL')),
+    )
 
-    id = Column(String, primary_key=True, default=ulid)
+    id = Column(ULIDKey, primary_key=True, default=ulid)
     username = Column(String, unique=True, nullable=False, index=True)
     password = Column(String, nullable=False)
     first_name = Column(String)
@@ -26,22 +34,39 @@ class User(Base):
     avatar = Column(String)
     about = Column(Text)
     role = Column(String, nullable=False)
+    # the end of the longest active ban (PERMANENT_BAN if it never ends), NULL if 
+    # the user has no ban; a past value means the ban has expired (until the
+    # ban sweeper clears it).
+    # Written in the same transaction as the bans (db.crud), instead of being 
+    # worked out from the bans table on every read
+    banned_until = Column(DateTime)
     
     library = relationship('Library', back_populates='user')
     ban = relationship('Ban', back_populates='user')
     
-    def set_password(self, password: str) -> None:
+    @staticmethod
+    def validate_password(password: str) -> None:
         regex = re.compile(
             r'^(?!.*(.)\1{3})(?=.*[a-z])(?=.*[A-Z])(?=.*\d)(?=.*[\W_])[a-zA-Z\d\W_]{6,24}$'
         )
         if (not regex.match(password) or sum(c.isalpha() for c in password) 
             <= sum(c.isdigit() for c in password)):
             raise ValidateError(f'the password is invalid')
+    
+    def set_password(self, password: str) -> None:
+        self.validate_password(password)
         self.password = pwd_context.hash(password)
 
     def check_password(self, password: str) -> bool:
         return pwd_context.verify(password, self.password)  # type: ignore[reportArgumentType]
     
+    async def set_password_async(self, password: str) -> None:
+        self.validate_password(password)
+        self.password = await hash_password(password)
+        
+    async def check_password_async(self, password: str) -> bool:
+        return await verify_password(password, self.password)  # type: ignore[reportArgumentType]
+    
     @validates("username")
     def validate_username(self, key, value: str):
         if not re.match(r'^[A-Za-z]{3}[A-Za-z0-9]{1,21}$', value):
@@ -63,15 +88,19 @@ class User(Base):
     
 class Library(Base):
     __tablename__ = 'libraries'
+    __table_args__ = (
+        # also serves lookups by user_id alone (leading column)
+        UniqueConstraint('user_id', 'book_id', name='uq_libraries_user_id_book_id'),
+    )
     
     class Status(enum.Enum):
         PLANNING = 0
         READING = 1
         FINISHED = 2
     
-    id = Column(String, primary_key=True, default=ulid)
-    book_id = Column(String, nullable=False)
-    user_id = Column(String, ForeignKey('users.id'), nullable=False)
+    id = Column(ULIDKey, primary_key=True, default=ulid)
+    book_id = Column(String, nullable=False, index=True)
+    user_id = Column(ULIDKey, ForeignKey('users.id'), nullable=False)
     status = Column(Enum(Status), nullable=False)
     
     user = relationship('User', back_populates='library')
@@ -79,15 +108,19 @@ class Library(Base):
     
 class Ban(Base):
     __tablename__ = 'bans'
+    __table_args__ = (
+        # also serves lookups by user_id alone (leading column)
+        Index('ix_bans_user_id_end_date', 'user_id', 'end_date'),
+    )
     
     class Reason(enum.Enum):
         INAPPROPRIATE_BEHAVIOR = 0
     
-    id = Column(String, primary_key=True, default=ulid)
-    user_id = Column(String, ForeignKey('users.id'), nullable=False)
+    id = Column(ULIDKey, primary_key=True, default=ulid)
+    user_id = Column(ULIDKey, ForeignKey('users.id'), nullable=False)
     reason = Column(Enum(Reason), nullable=False)
     comment = Column(Text)
-    end_date = Column(DateTime)
+    end_date = Column(DateTime, index=True)
     
     user = relationship('User', back_populates='ban')
     
@@ -95,4 +128,20 @@ class Ban(Base):
     def validate_end_date(self, key, value: datetime):
         if value < datetime.now():
             raise ValidateError(f'The end date of the ban must be greater than the current time (recived {value})')
-        return value
\ No newline at end of file
+        return value
+
+
+class BanArchive(Base):
+    '''
+    Bans moved out of the hot bans table: ones that ended more than 
+    BAN_ARCHIVE_AFTER_DAYS ago and revoked ones
+    '''
+    __tablename__ = 'bans_archive'
+    
+    id = Column(ULIDKey, primary_key=True)
+    user_id = Column(ULIDKey, nullable=False, index=True)
+    reason = Column(Enum(Ban.Reason), nullable=False)
+    comment = Column(Text)
+    end_date = Column(DateTime)
+    revoked_at = Column(DateTime)
+    archived_at = Column(DateTime, nullable=False, server_default=text('now()'))
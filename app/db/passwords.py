@@ -0,0 +1,127 @@
+"""
+This module moves bcrypt hashing and verification off the asyncio event loop.
+
+bcrypt is deliberately slow, so running it inline blocks every other request
+served by the worker. The work is submitted to a shared executor (a thread pool
+by default, since bcrypt releases the GIL, or a process pool) and the number of
+submitted jobs is bounded by a semaphore, so a registration burst waits on the
+semaphore instead of piling up unbounded work inside the executor.
+
+Functions:
+    hash_password: Hashes the password in the executor.
+    verify_password: Verifies the password against the hash in the executor.
+    shutdown: Shuts the executor down.
+"""
+
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+import config
+from metrics import Gauge, Histogram
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+T = TypeVar('T')
+
+hash_queue_depth = Gauge(
+    'users_password_hash_queue_depth',
+    'Password hashing jobs waiting for a free executor slot'
+)
+hash_in_progress = Gauge(
+    'users_password_hash_in_progress',
+    'Password hashing jobs currently running in the executor'
+)
+hash_latency = Histogram(
+    'users_password_hash_seconds',
+    'Time spent on bcrypt inside the executor',
+    labelnames=('operation',)
+)
+hash_wait = Histogram(
+    'users_password_hash_wait_seconds',
+    'Time spent waiting for a free executor slot'
+)
+
+_executor: Optional[Executor] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _hash(password: str) -> tuple[str, float]:
+    start = time.perf_counter()
+    hashed = pwd_context.hash(password)
+    return hashed, time.perf_counter() - start
+
+
+def _verify(password: str, hashed: str) -> tuple[bool, float]:
+    start = time.perf_counter()
+    is_valid = pwd_context.verify(password, hashed)
+    return is_valid, time.perf_counter() - start
+
+
+def _get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if config.PASSWORD_HASH_EXECUTOR == 'process':
+            _executor = ProcessPoolExecutor(max_workers=config.PASSWORD_HASH_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=config.PASSWORD_HASH_WORKERS,
+                                           thread_name_prefix='bcrypt')
+    return _executor
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(config.PASSWORD_HASH_MAX_PENDING)
+    return _semaphore
+
+
+async def _run(operation: str, func: Callable[..., tuple[T, float]], *args) -> T:
+    semaphore = _get_semaphore()
+    hash_queue_depth.inc()
+    start = time.perf_counter()
+    try:
+        await semaphore.acquire()
+    finally:
+        hash_queue_depth.dec()
+    hash_wait.observe(time.perf_counter() - start)
+
+    hash_in_progress.inc()
+    try:
+        future = asyncio.get_running_loop().run_in_executor(_get_executor(), func, *args)
+    except BaseException:
+        hash_in_progress.dec()
+        semaphore.release()
+        raise
+
+    def release(done: asyncio.Future) -> None:
+        # the job keeps running in the executor when the awaiting task is 
+        # cancelled (e.g. a client disconnect), its slot is freed once it ends
+        hash_in_progress.dec()
+        semaphore.release()
+        if not done.cancelled():
+            done.exception()  # nobody may be waiting, don't log it as never retrieved
+    future.add_done_callback(release)
+
+    # shielded: cancelling the asyncio future would mark it done (and free 
+    # the slot) at once, while a started job can't be stopped
+    result, duration = await asyncio.shield(future)
+    hash_latency.labels(operation).observe(duration)
+    return result
+
+
+async def hash_password(password: str) -> str:
+    return await _run('hash', _hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await _run('verify', _verify, password, hashed)
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
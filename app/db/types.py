@@ -0,0 +1,71 @@
+"""
+This module contains the column type of the ULID keys.
+
+The keys are ULIDs, exposed everywhere (API, GraphQL, JWT claims, caches) as
+their canonical 26 character string. With DATABASE_UUID_IDS they are stored
+as native 16 byte uuid values instead of varchar(26), which roughly halves
+the primary key and foreign key indexes and makes comparisons in joins and
+IN filters fixed-size. A ULID and its UUID share the same 128 bits in the
+same order and PostgreSQL compares uuid values bytewise, so the order by id
+(and with it the keyset cursors) is the same in both storages.
+
+Existing databases are converted with python -m db.migrations ids-to-uuid.
+
+Classes:
+    ULIDKey: ULID string at the edge, varchar or uuid in the database.
+
+Functions:
+    to_storage: Converts a ULID string to the stored value.
+"""
+
+import uuid
+from typing import Any, Optional
+
+import config
+from sqlalchemy import String, Uuid
+from sqlalchemy.engine import Dialect
+from sqlalchemy.types import TypeDecorator, TypeEngine
+from ulid import ULID
+
+
+def to_storage(value: Optional[str], as_uuid: bool = config.DATABASE_UUID_IDS) -> Any:
+    '''
+    Converts a ULID string to the value stored in the database, for code
+    bypassing the ORM (e.g. COPY). A string that is not a ULID can't be
+    the key of any row and becomes None, so it matches nothing
+    '''
+    if value is None or not as_uuid:
+        return value
+    try:
+        return ULID.from_str(value).to_uuid()
+    except ValueError:
+        return None
+
+
+class ULIDKey(TypeDecorator):
+    """
+    ULID string at the edge, varchar or uuid in the database.
+
+    Args:
+        as_uuid (bool): Store the keys as uuid, DATABASE_UUID_IDS by default.
+    """
+
+    impl = String
+    cache_ok = True
+
+    def __init__(self, as_uuid: bool = config.DATABASE_UUID_IDS) -> None:
+        super().__init__()
+        self.as_uuid = as_uuid
+
+    def load_dialect_impl(self, dialect: Dialect) -> TypeEngine[Any]:
+        if self.as_uuid:
+            return dialect.type_descriptor(Uuid(as_uuid=True))
+        return dialect.type_descriptor(String())
+
+    def process_bind_param(self, value: Optional[str], dialect: Dialect) -> Any:
+        return to_storage(value, self.as_uuid)
+
+    def process_result_value(self, value: Any, dialect: Dialect) -> Optional[str]:
+        if isinstance(value, uuid.UUID):
+            return str(ULID.from_uuid(value))
+        return value
@@ -4,39 +4,68 @@ from contextlib import asynccontextmanager
 import config
 from api import router
 from api.graphql.resolvers import resolvers
-from db.base import get_session
+from api.graphql.route import create_graphql_route
+from api.telemetry import MetricsMiddleware, metrics_route
+from db import passwords
+from db.base import (engine, get_read_session, replicas, replicas_health_task,
+                     warm_up)
+from db.crud import ban_expiry_task
 from fastapi import FastAPI
 from patisson_appLauncher.fastapi_app_launcher import UvicornFastapiAppLauncher
-from patisson_graphql.framework_utils.fastapi import create_graphql_route
 from patisson_request.service_routes import UsersRoute
+from profiling import ProfilingMiddleware
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     task = asyncio.create_task(config.SelfService.tokens_update_task())
+    ban_task = asyncio.create_task(ban_expiry_task())
+    health_task = asyncio.create_task(replicas_health_task()) if replicas else None
+    try:
+        await asyncio.gather(
+            warm_up(engine, config.DATABASE_POOL_WARMUP),
+            *(warm_up(replica.engine, config.DATABASE_POOL_WARMUP) for replica in replicas)
+        )
+    except Exception as e:
+        config.logger.warning('the database pool warm-up failed: %r', e)
     yield
-    task.cancel()
-    await task
+    tasks = [task for task in (task, ban_task, health_task) if task is not None]
+    for task_ in tasks:
+        task_.cancel()
+    # the tasks may re-raise CancelledError, the teardown below must still run
+    await asyncio.gather(*tasks, return_exceptions=True)
+    passwords.shutdown()
+    await engine.dispose()
+    for replica in replicas:
+        await replica.engine.dispose()
 
 app = FastAPI(title=config.SERVICE_NAME, lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ProfilingMiddleware)
 
 if __name__ == "__main__":
     health_path = f'/{config.SERVICE_NAME}/{UsersRoute.health().path}'
+    metrics_path = '/metrics'
     
     app_launcher = UvicornFastapiAppLauncher(app, router,
                         service_name=config.SERVICE_NAME,
                         host=config.SERVICE_HOST)
     app_launcher.add_token_middleware(
         config.SelfService.get_access_token,
-        excluded_paths=[health_path]
+        excluded_paths=[health_path, metrics_path]
         )
     app_launcher.add_sync_consul_health_path()
     app_launcher.consul_register(health_path)
     app_launcher.add_jaeger()
     app_launcher.add_route(
         path='/graphql', 
-        endpoint=create_graphql_route(resolvers, get_session), 
+        endpoint=create_graphql_route(resolvers, get_read_session), 
         methods=["POST"]
         )
+    app_launcher.add_route(
+        path=metrics_path,
+        endpoint=metrics_route,
+        methods=["GET"]
+        )
     app_launcher.include_router(prefix=f'/{config.SERVICE_NAME}')
     app_launcher.app_run()
\ No newline at end of file
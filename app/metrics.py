@@ -0,0 +1,199 @@
+"""
+This module contains lightweight in-process metrics used by the Users service.
+
+The primitives intentionally mirror the Prometheus data model (counters, gauges
+and histograms with optional labels) so they can be exported without pulling
+an extra dependency into the service. Updating a metric is a dictionary lookup
+plus an integer/float addition, so they are safe to keep on the hot path.
+
+Classes:
+    Counter: A monotonically increasing value.
+    Gauge: A value that can go up and down.
+    Histogram: Bucketed observations with a running count and sum.
+
+Functions:
+    collect: Returns every registered metric.
+    timed: Decorator observing the duration of an async function.
+    render: Renders every registered metric in the Prometheus text format.
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Iterator, Optional
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075,
+    0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0
+)
+
+_registry: dict[str, '_Metric'] = {}
+
+
+class _Metric:
+    type_: str = ''
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()) -> None:
+        if name in _registry:
+            raise ValueError(f'the metric ({name}) is already registered')
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], _Metric] = {}
+        _registry[name] = self
+
+    def _new_child(self) -> '_Metric':
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'the metric ({self.name}) expects labels {self.labelnames}')
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self) -> Iterator[tuple[tuple[str, ...], '_Metric']]:
+        if self.labelnames:
+            yield from list(self._children.items())
+        else:
+            yield (), self
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def _new_child(self) -> 'Counter':
+        child = Counter.__new__(Counter)
+        child.value = 0.0
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge(_Metric):
+    type_ = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def _new_child(self) -> 'Gauge':
+        child = Gauge.__new__(Gauge)
+        child.value = 0.0
+        return child
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._init_values(buckets)
+
+    def _init_values(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def _new_child(self) -> 'Histogram':
+        child = Histogram.__new__(Histogram)
+        child._init_values(self.buckets)
+        return child
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+def collect() -> list[_Metric]:
+    return list(_registry.values())
+
+
+def timed(histogram: Histogram, *labels: str):
+    '''
+    Decorator observing the duration of every call of the async function
+    '''
+    child = histogram.labels(*labels) if labels else histogram
+    
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], 
+            extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_float(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render() -> str:
+    '''
+    Renders every registered metric in the Prometheus text exposition format
+    '''
+    lines = []
+    for metric in collect():
+        lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+        lines.append(f'# TYPE {metric.name} {metric.type_}')
+        for values, sample in metric.samples():
+            if isinstance(sample, Histogram):
+                cumulative = 0
+                for bound, count in zip(sample.buckets + (float('inf'),), sample.bucket_counts):
+                    cumulative += count
+                    le = ('le', _format_float(bound))
+                    lines.append(f'{metric.name}_bucket{_labels(metric.labelnames, values, le)} {cumulative}')
+                lines.append(f'{metric.name}_sum{_labels(metric.labelnames, values)} {_format_float(sample.sum)}')
+                lines.append(f'{metric.name}_count{_labels(metric.labelnames, values)} {sample.count}')
+            else:
+                lines.append(f'{metric.name}{_labels(metric.labelnames, values)} '
+                             f'{_format_float(sample.value)}')  # type: ignore[reportAttributeAccessIssue]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,203 @@
+"""
+This module contains the opt-in per-request profiler of the Users service.
+
+A request is profiled when it carries the X-Profile header (if
+PROFILING_HEADER_ENABLED), when it is picked by PROFILING_SAMPLE_RATE, or,
+if PROFILING_SLOW_THRESHOLD is set, for every request, keeping only those
+slower than the threshold. A profile is a per-phase timing breakdown filled
+by profile_phase blocks placed around dependency resolution, upstream calls
+and database round trips; the time between the last phase and the start of
+the response is reported as 'response' and anything unaccounted as 'other'.
+
+With PROFILING_SAMPLER_INTERVAL set, a background thread samples the stack of
+the event loop thread, and a kept profile gets the collapsed stacks sampled
+during the request, which shows what blocked the loop while it was running.
+
+Kept profiles are written as JSON files to PROFILING_DIR (the oldest ones are
+removed beyond PROFILING_MAX_FILES) and the latest ones stay in memory for the
+admin route.
+
+Classes:
+    RequestProfile: The timing breakdown of a single request.
+    ProfilingMiddleware: ASGI middleware profiling the selected requests.
+
+Functions:
+    profile_phase: Adds the duration of the block to the current profile.
+    recent_profiles: Returns the latest kept profiles.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+import config
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from ulid import ULID
+
+_current_profile: ContextVar[Optional['RequestProfile']] = ContextVar('current_profile', default=None)
+_recent: deque[dict[str, Any]] = deque(maxlen=config.PROFILING_KEEP_IN_MEMORY)
+
+
+class RequestProfile:
+    __slots__ = ('method', 'path', 'start', 'phases', 'last_phase_end')
+
+    def __init__(self, method: str, path: str) -> None:
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.last_phase_end = self.start
+
+    def add(self, phase: str, duration: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + duration
+        self.last_phase_end = time.perf_counter()
+
+
+@contextmanager
+def profile_phase(phase: str) -> Iterator[None]:
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(phase, time.perf_counter() - start)
+
+
+class _StackSampler(threading.Thread):
+    '''
+    Samples the stack of the event loop thread into a ring buffer
+    of (timestamp, collapsed stack)
+    '''
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: deque[tuple[float, str]] = deque(
+            maxlen=int(config.PROFILING_SAMPLER_WINDOW / interval))
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), ';'.join(reversed(stack))))
+
+    def snapshot(self, start: float, end: float) -> dict[str, int]:
+        return dict(Counter(stack for at, stack in list(self.samples) if start <= at <= end))
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def _write(profile: dict[str, Any]) -> None:
+    try:
+        os.makedirs(config.PROFILING_DIR, exist_ok=True)
+        with open(os.path.join(config.PROFILING_DIR, f'{profile["id"]}.json'), 'w') as file:
+            json.dump(profile, file)
+        files = sorted(name for name in os.listdir(config.PROFILING_DIR) if name.endswith('.json'))
+        for name in files[:-config.PROFILING_MAX_FILES]:  # ULID names sort by creation time
+            os.remove(os.path.join(config.PROFILING_DIR, name))
+    except OSError as e:
+        config.logger.warning('the profile %s was not written: %r', profile['id'], e)
+
+
+def recent_profiles() -> list[dict[str, Any]]:
+    return list(reversed(_recent))
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware profiling the selected requests.
+
+    Notes:
+        Requests profiled because of the X-Profile header also get the
+        breakdown back in the Server-Timing response header.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.sampler: Optional[_StackSampler] = None
+
+    def _start_sampler(self) -> None:
+        if self.sampler is None and config.PROFILING_SAMPLER_INTERVAL > 0:
+            self.sampler = _StackSampler(threading.get_ident(), config.PROFILING_SAMPLER_INTERVAL)
+            self.sampler.start()
+
+    def _is_requested(self, scope: Scope) -> bool:
+        return config.PROFILING_HEADER_ENABLED and any(
+            name == b'x-profile' for name, _ in scope['headers'])
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        requested = self._is_requested(scope)
+        sampled = (config.PROFILING_SAMPLE_RATE > 0
+                   and random.random() < config.PROFILING_SAMPLE_RATE)
+        if not (requested or sampled or config.PROFILING_SLOW_THRESHOLD > 0):
+            await self.app(scope, receive, send)
+            return
+
+        self._start_sampler()
+        profile = RequestProfile(scope['method'], scope['path'])
+        response_start: Optional[float] = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_start
+            if message['type'] == 'http.response.start':
+                response_start = time.perf_counter()
+                if requested:
+                    timings = ', '.join(f'{phase.replace(".", "_")};dur={duration * 1000:.3f}'
+                                        for phase, duration in profile.phases.items())
+                    message['headers'] = list(message.get('headers', [])) + [
+                        (b'server-timing', timings.encode())]
+            await send(message)
+
+        token = _current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_profile.reset(token)
+            end = time.perf_counter()
+            total = end - profile.start
+            if requested or sampled or total >= config.PROFILING_SLOW_THRESHOLD:
+                self._keep(profile, scope, end, response_start)
+
+    def _keep(self, profile: RequestProfile, scope: Scope,
+              end: float, response_start: Optional[float]) -> None:
+        route = scope.get('route')
+        phases = dict(profile.phases)
+        if response_start is not None:
+            phases['response'] = max(response_start - profile.last_phase_end, 0.0)
+        total = end - profile.start
+        phases['other'] = max(total - sum(phases.values()), 0.0)
+        result: dict[str, Any] = {
+            'id': str(ULID()),
+            'timestamp': time.time(),
+            'method': profile.method,
+            'path': profile.path,
+            'route': getattr(route, 'path', None),
+            'total_ms': total * 1000,
+            'phases_ms': {phase: duration * 1000 for phase, duration in phases.items()},
+        }
+        if self.sampler is not None:
+            result['stacks'] = self.sampler.snapshot(profile.start, end)
+        _recent.append(result)
+        if config.PROFILING_DIR:
+            asyncio.get_running_loop().run_in_executor(None, _write, result)
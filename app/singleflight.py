@@ -0,0 +1,79 @@
+"""
+This module contains the single-flight helper used to coalesce concurrent
+identical lookups (database reads, calls to other services).
+
+Classes:
+    SingleFlight: Lets concurrent calls with the same key share one execution.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+
+from metrics import Counter
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class SingleFlight(Generic[K, V]):
+    """
+    Lets concurrent calls with the same key share one execution.
+
+    The first caller (the leader) runs the call itself, callers arriving
+    while it is in flight wait for its result (or exception) instead of
+    running their own. Nothing is kept once the call completes, caching
+    is up to the caller.
+
+    Args:
+        name (str): The prefix of the exported metrics, e.g. 'users_user_status'.
+
+    Notes:
+        The call runs in the leader's task, so it may use the leader's
+        resources (e.g. its db session). If the leader is cancelled,
+        the waiting callers run the call themselves. Only idempotent
+        calls should be coalesced.
+    """
+
+    def __init__(self, name: str) -> None:
+        self._in_flight: dict[K, asyncio.Future[V]] = {}
+        self.coalesced = Counter(
+            f'{name}_coalesced_total', f'{name} calls that joined an in-flight call')
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced.inc()
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise  # this caller was cancelled
+                return await func()
+
+        future = self._in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # nobody may be waiting, don't log it as never retrieved
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def forget(self, key: K) -> None:
+        '''
+        Makes later calls with the key start a new execution, e.g. after 
+        a write made the in-flight result outdated. The callers already 
+        waiting still get the result of the current one
+        '''
+        self._in_flight.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._in_flight)